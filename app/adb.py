@@ -0,0 +1,71 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from . import db
+from . import reports
+
+# Асинхронная обёртка над db: все запросы идут в один выделенный поток со своим
+# соединением, хэндлеры только await-ят. Очередь ограничена, чтобы при залипшем
+# fsync не копить бесконечно задач.
+MAX_PENDING = 256
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="paybot-db")
+_slots: Optional[asyncio.Semaphore] = None
+
+async def run(fn, *args, **kwargs):
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(MAX_PENDING)
+    async with _slots:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+def _wrap(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await run(fn, *args, **kwargs)
+    return wrapper
+
+create_request = _wrap(db.create_request)
+get_request = _wrap(db.get_request)
+add_comment = _wrap(db.add_comment)
+# Записи, меняющие решённые заявки, сразу сбрасывают кэш /report за месяц решения.
+# Кэш живёт в event loop, поэтому сброс здесь, после await, а не в потоке БД.
+def _invalidating(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        res = await run(fn, *args, **kwargs)
+        for row in res if isinstance(res, list) else [res]:
+            if row is not None and row["decision_at"]:
+                reports.invalidate(row["decision_at"])
+        return res
+    return wrapper
+
+set_decision = _invalidating(db.set_decision)
+rework_request = _invalidating(db.rework_request)
+decide_many = _invalidating(db.decide_many)
+pending_page = _wrap(db.pending_page)
+get_comments = _wrap(db.get_comments)
+get_attachments = _wrap(db.get_attachments)
+update_attachment_file_ids = _wrap(db.update_attachment_file_ids)
+set_attachment_archive = _wrap(db.set_attachment_archive)
+get_changes = _wrap(db.get_changes)
+search_requests = _wrap(db.search_requests)
+save_admin_cards = _wrap(db.save_admin_cards)
+get_admin_cards = _wrap(db.get_admin_cards)
+save_digest_cards = _wrap(db.save_digest_cards)
+digest_message_requests = _wrap(db.digest_message_requests)
+get_admin_settings = _wrap(db.get_admin_settings)
+set_notify_mode = _wrap(db.set_notify_mode)
+queue_digest = _wrap(db.queue_digest)
+due_digests = _wrap(db.due_digests)
+digest_batch = _wrap(db.digest_batch)
+ack_digest = _wrap(db.ack_digest)
+load_fsm_states = _wrap(db.load_fsm_states)
+save_fsm_states = _wrap(db.save_fsm_states)
+
+async def shutdown():
+    await run(db.close)
+    _executor.shutdown(wait=True)
@@ -0,0 +1,66 @@
+import sys
+
+from . import db
+from . import migrations
+
+# month_totals ведётся триггерами (см. migrations); здесь — чтение и сверка с пересчётом с нуля.
+FRESH_SQL = """
+    SELECT substr(decision_at, 1, 7) AS month, status,
+           COALESCE(budget_category, '') AS budget_category,
+           COALESCE(payment_type, '') AS payment_type,
+           COUNT(*) AS cnt, COALESCE(SUM(amount), 0) AS total
+    FROM requests
+    WHERE status IN ('approved','rejected') AND decision_at IS NOT NULL
+    GROUP BY 1, 2, 3, 4
+"""
+
+def month_status_totals(year: str, month2: str):
+    with db.conn() as c:
+        rows = c.execute("""
+            SELECT status, SUM(cnt) AS cnt, SUM(total) AS s
+            FROM month_totals
+            WHERE month = ?
+            GROUP BY status
+        """, (f"{int(year):04d}-{int(month2):02d}",)).fetchall()
+    return {r["status"]: (int(r["cnt"]), float(r["s"])) for r in rows}
+
+def _key(r):
+    return (r["month"], r["status"], r["budget_category"], r["payment_type"])
+
+def drift():
+    with db.conn() as c:
+        stored = {_key(r): (int(r["cnt"]), float(r["total"])) for r in c.execute("SELECT * FROM month_totals")}
+        fresh = {_key(r): (int(r["cnt"]), float(r["total"])) for r in c.execute(FRESH_SQL)}
+    out = []
+    for k in sorted(set(stored) | set(fresh)):
+        s_cnt, s_sum = stored.get(k, (0, 0.0))
+        f_cnt, f_sum = fresh.get(k, (0, 0.0))
+        if s_cnt != f_cnt or abs(s_sum - f_sum) > 0.005:
+            out.append((k, (s_cnt, s_sum), (f_cnt, f_sum)))
+    return out
+
+def rebuild():
+    with db.conn() as c:
+        c.execute("DELETE FROM month_totals")
+        c.execute(f"""
+            INSERT INTO month_totals(month, status, budget_category, payment_type, cnt, total)
+            {FRESH_SQL}
+        """)
+        c.commit()
+
+def main():
+    migrations.migrate()
+    diff = drift()
+    for (month, status, bud, pay), (s_cnt, s_sum), (f_cnt, f_sum) in diff:
+        print(f"drift:{month}:{status}:{bud}:{pay} stored={s_cnt}/{s_sum:.2f} fresh={f_cnt}/{f_sum:.2f}")
+    if not diff:
+        print("month_totals_ok")
+        return
+    if "--fix" in sys.argv[1:]:
+        rebuild()
+        print("month_totals_rebuilt")
+        return
+    raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import os
+import asyncio
+import hashlib
+import logging
+import tempfile
+from typing import List, Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, InputMediaDocument, InputMediaPhoto
+
+from . import adb
+from .notify import Step
+
+log = logging.getLogger(__name__)
+
+# Локальный архив вложений (по желанию): файлы лежат по sha256, одинаковые хранятся один раз.
+ARCHIVE_DIR = os.environ.get("PAYBOT_ARCHIVE_DIR", "").strip()
+MEDIA_GROUP_MAX = 10
+
+_tasks: Set[asyncio.Task] = set()
+
+def _kind(a) -> str:
+    return "photo" if a["kind"] == "photo" else "document"
+
+def _groups(atts):
+    # Telegram не смешивает фото и документы в одном альбоме, и в альбоме не больше 10 файлов
+    for kind in ("photo", "document"):
+        same = [a for a in atts if _kind(a) == kind]
+        for i in range(0, len(same), MEDIA_GROUP_MAX):
+            yield kind, same[i:i + MEDIA_GROUP_MAX]
+
+async def _send(b: Bot, chat_id: int, kind: str, group, caption: str, source):
+    if len(group) == 1:
+        if kind == "photo":
+            return [await b.send_photo(chat_id, photo=source(group[0]), caption=caption)]
+        return [await b.send_document(chat_id, document=source(group[0]), caption=caption)]
+    cls = InputMediaPhoto if kind == "photo" else InputMediaDocument
+    media = [cls(media=source(a), caption=caption if i == 0 else None) for i, a in enumerate(group)]
+    return await b.send_media_group(chat_id, media=media)
+
+def _file_id(m, kind: str) -> Optional[str]:
+    if kind == "photo" and m.photo:
+        return m.photo[-1].file_id
+    return m.document.file_id if m.document else None
+
+def send_steps(atts, caption: str) -> List[Step]:
+    # Шаги для FanOut: по альбому на каждый вид файлов. Шлём по сохранённому file_id;
+    # если Telegram его не принял и файл есть в архиве — загружаем заново и запоминаем новый id,
+    # так что следующие получатели (и следующие отправки) снова идут без загрузки.
+    atts = [dict(a) for a in atts]
+    steps: List[Step] = []
+    for kind, group in _groups(atts):
+        async def step(b: Bot, chat_id: int, kind=kind, group=group):
+            try:
+                return await _send(b, chat_id, kind, group, caption, lambda a: a["file_id"])
+            except TelegramBadRequest:
+                if not all(a["local_path"] and os.path.exists(a["local_path"]) for a in group):
+                    raise
+                log.warning("file ids rejected for attachments %s, re-uploading", [a["id"] for a in group])
+                sent = await _send(b, chat_id, kind, group, caption, lambda a: FSInputFile(a["local_path"]))
+                fresh = []
+                for a, m in zip(group, sent):
+                    fid = _file_id(m, kind)
+                    if fid:
+                        a["file_id"] = fid
+                        fresh.append((a["id"], fid))
+                await adb.update_attachment_file_ids(fresh)
+                return sent
+        steps.append(step)
+    return steps
+
+def _store(tmp: str) -> tuple:
+    h = hashlib.sha256()
+    with open(tmp, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    sha = h.hexdigest()
+    path = os.path.join(ARCHIVE_DIR, sha[:2], sha)
+    if os.path.exists(path):
+        os.unlink(tmp)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp, path)
+    return sha, path
+
+async def archive(bot: Bot, req_id: int):
+    for a in await adb.get_attachments(req_id):
+        if a["local_path"]:
+            continue
+        fd, tmp = tempfile.mkstemp(prefix=".incoming-", dir=ARCHIVE_DIR)
+        os.close(fd)
+        try:
+            await bot.download(a["file_id"], destination=tmp)
+            sha, path = await asyncio.to_thread(_store, tmp)
+        except Exception:
+            log.exception("archiving attachment %s of request %s failed", a["id"], req_id)
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            continue
+        await adb.set_attachment_archive(a["id"], sha, path)
+
+def schedule_archive(bot: Bot, req_id: int):
+    if not ARCHIVE_DIR:
+        return
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    task = asyncio.create_task(archive(bot, req_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
@@ -1,14 +1,41 @@
+import re
 import sqlite3
-from typing import Optional, Dict, Any
+import threading
+from typing import Optional, Dict, Any, Sequence, Tuple
 
 DB = "/opt/services/paybot/data/db.sqlite3"
+BUSY_TIMEOUT_MS = 5000
+STATEMENT_CACHE = 256
 
+_local = threading.local()
+
+# Одно соединение на поток, живёт весь процесс. WAL даёт боту и экспорту
+# читать и писать одновременно, busy_timeout ждёт чужую запись вместо "database is locked".
 def conn():
-    c = sqlite3.connect(DB)
-    c.row_factory = sqlite3.Row
-    c.execute("PRAGMA foreign_keys = ON;")
+    c = getattr(_local, "conn", None)
+    if c is None:
+        c = sqlite3.connect(DB, timeout=BUSY_TIMEOUT_MS / 1000, cached_statements=STATEMENT_CACHE)
+        c.row_factory = sqlite3.Row
+        c.execute("PRAGMA journal_mode = WAL;")
+        c.execute("PRAGMA synchronous = NORMAL;")
+        c.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS};")
+        c.execute("PRAGMA foreign_keys = ON;")
+        _local.conn = c
     return c
 
+def close():
+    c = getattr(_local, "conn", None)
+    if c is not None:
+        c.execute("PRAGMA optimize;")
+        c.close()
+        _local.conn = None
+
+def month_range(year: str, month2: str):
+    # [начало месяца, начало следующего) — диапазон по decision_at идёт по индексу, в отличие от strftime
+    y, m = int(year), int(month2)
+    ny, nm = (y + 1, 1) if m == 12 else (y, m + 1)
+    return f"{y:04d}-{m:02d}-01", f"{ny:04d}-{nm:02d}-01"
+
 def create_request(
     author_id: int,
     author_name: str,
@@ -18,7 +45,11 @@ def create_request(
     budget_category: str,
     attachment_file_id: Optional[str],
     attachment_kind: Optional[str],
+    attachments: Sequence[Tuple[str, str, Optional[str]]] = (),
 ):
+    # attachments — (kind, file_id, file_unique_id); первый файл дублируется в requests.attachment_*
+    if attachments and not attachment_file_id:
+        attachment_kind, attachment_file_id = attachments[0][0], attachments[0][1]
     with conn() as c:
         cur = c.execute(
             """
@@ -31,8 +62,19 @@ def create_request(
             (author_id, author_name, title.strip(), float(amount),
              attachment_file_id, attachment_kind, payment_type, budget_category),
         )
+        req_id = cur.lastrowid
+        if attachments:
+            c.executemany(
+                "INSERT INTO request_attachments(request_id, kind, file_id, file_unique_id) VALUES (?,?,?,?)",
+                [(req_id, kind, file_id, unique_id) for kind, file_id, unique_id in attachments],
+            )
+        elif attachment_file_id:
+            c.execute(
+                "INSERT INTO request_attachments(request_id, kind, file_id) VALUES (?,?,?)",
+                (req_id, attachment_kind or "document", attachment_file_id),
+            )
         c.commit()
-        return cur.lastrowid
+        return req_id
 
 def get_request(req_id: int):
     with conn() as c:
@@ -46,9 +88,14 @@ def add_comment(req_id: int, author_id: int, author_name: str, text: str):
         )
         c.commit()
 
-def set_decision(req_id: int, status: str, admin_id: int, admin_name: str, decision_comment: str) -> int:
+# Запись + чтение результата — одна транзакция и один UPDATE ... RETURNING: хендлерам не нужно
+# перечитывать заявку, а условие по статусу заменяет отдельную проверку перед записью.
+EDITABLE_FIELDS = ("title", "amount", "payment_type", "budget_category")
+
+def set_decision(req_id: int, status: str, admin_id: int, admin_name: str, decision_comment: str):
+    # None — заявка уже не new/rework (решили параллельно)
     with conn() as c:
-        cur = c.execute(
+        rows = c.execute(
             """
             UPDATE requests
             SET status = ?,
@@ -58,29 +105,104 @@ def set_decision(req_id: int, status: str, admin_id: int, admin_name: str, decis
                 decision_comment = ?,
                 exported_to_sheets = 0
             WHERE id = ? AND status IN ('new','rework')
+            RETURNING *
             """,
             (status, admin_id, admin_name, (decision_comment or "").strip(), req_id),
-        )
+        ).fetchall()
+        c.commit()
+        return rows[0] if rows else None
+
+def rework_request(
+    req_id: int,
+    fields: Optional[Dict[str, Any]] = None,
+    comment: Optional[str] = None,
+    author_id: Optional[int] = None,
+    author_name: Optional[str] = None,
+):
+    # правка полей + перевод в rework + комментарий; None — заявка уже решена, ничего не записано
+    keys = [k for k in EDITABLE_FIELDS if k in (fields or {})]
+    sets = "".join(f"{k}=?, " for k in keys)
+    with conn() as c:
+        rows = c.execute(
+            f"UPDATE requests SET {sets}status='rework' WHERE id=? AND status IN ('new','rework') RETURNING *",
+            [fields[k] for k in keys] + [req_id],
+        ).fetchall()
+        if rows and (comment or "").strip():
+            c.execute(
+                "INSERT INTO comments(request_id, author_tg_id, author_name, text) VALUES (?,?,?,?)",
+                (req_id, author_id, author_name, comment.strip()),
+            )
+        c.commit()
+        return rows[0] if rows else None
+
+def decide_many(req_ids, status: str, admin_id: int, admin_name: str, decision_comment: str = ""):
+    # решение пачкой: одна транзакция, уже решённые параллельно просто не попадают в результат
+    ids = [int(i) for i in req_ids]
+    if not ids:
+        return []
+    with conn() as c:
+        rows = c.execute(
+            f"""
+            UPDATE requests
+            SET status = ?,
+                decision_at = datetime('now'),
+                decision_by_tg_id = ?,
+                decision_by_name = ?,
+                decision_comment = ?,
+                exported_to_sheets = 0
+            WHERE id IN ({",".join("?" * len(ids))}) AND status IN ('new','rework')
+            RETURNING *
+            """,
+            [status, admin_id, admin_name, (decision_comment or "").strip()] + ids,
+        ).fetchall()
         c.commit()
-        return cur.rowcount
+        return sorted(rows, key=lambda r: r["id"])
+
+PENDING_PAGE = 8
+
+def pending_page(after: int = 0, before: Optional[int] = None, limit: int = PENDING_PAGE):
+    # Keyset по id среди new/rework (частичный индекс idx_requests_open):
+    # after — страница вперёд от id, before — страница назад до id. -> (rows, has_prev, has_next)
+    with conn() as c:
+        if before is not None:
+            rows = c.execute(
+                "SELECT * FROM requests WHERE status IN ('new','rework') AND id < ? ORDER BY id DESC LIMIT ?",
+                (before, limit),
+            ).fetchall()[::-1]
+            has_next = True
+        else:
+            rows = c.execute(
+                "SELECT * FROM requests WHERE status IN ('new','rework') AND id > ? ORDER BY id LIMIT ?",
+                (after, limit + 1),
+            ).fetchall()
+            has_next = len(rows) > limit
+            rows = rows[:limit]
+        has_prev = bool(rows) and c.execute(
+            "SELECT 1 FROM requests WHERE status IN ('new','rework') AND id < ? LIMIT 1", (rows[0]["id"],)
+        ).fetchone() is not None
+        return rows, has_prev, has_next
 
-def set_status(req_id: int, status: str) -> int:
+def exported_ids(req_ids):
+    ids = [int(i) for i in req_ids]
     with conn() as c:
-        cur = c.execute("UPDATE requests SET status=? WHERE id=?", (status, req_id))
+        return {r["id"] for r in c.execute(
+            f"SELECT id FROM requests WHERE id IN ({','.join('?' * len(ids))}) AND exported_to_sheets = 1", ids,
+        )}
+
+def get_attachments(req_id: int):
+    with conn() as c:
+        return c.execute("SELECT * FROM request_attachments WHERE request_id=? ORDER BY id", (req_id,)).fetchall()
+
+def update_attachment_file_ids(pairs):
+    # (attachment_id, file_id) — id, который Telegram вернул после повторной загрузки из архива
+    with conn() as c:
+        c.executemany("UPDATE request_attachments SET file_id=? WHERE id=?", [(f, a) for a, f in pairs])
         c.commit()
-        return cur.rowcount
 
-def update_request_fields(req_id: int, fields: Dict[str, Any]) -> int:
-    allowed = {"title","amount","payment_type","budget_category"}
-    keys = [k for k in fields.keys() if k in allowed]
-    if not keys:
-        return 0
-    sets = ", ".join([f"{k}=?" for k in keys])
-    vals = [fields[k] for k in keys] + [req_id]
+def set_attachment_archive(att_id: int, sha256: str, local_path: str):
     with conn() as c:
-        cur = c.execute(f"UPDATE requests SET {sets} WHERE id=? AND status IN ('new','rework')", vals)
+        c.execute("UPDATE request_attachments SET sha256=?, local_path=? WHERE id=?", (sha256, local_path, att_id))
         c.commit()
-        return cur.rowcount
 
 def get_comments(req_id: int, limit: int = 10):
     with conn() as c:
@@ -88,3 +210,175 @@ def get_comments(req_id: int, limit: int = 10):
             "SELECT * FROM comments WHERE request_id=? ORDER BY id DESC LIMIT ?",
             (req_id, limit),
         ).fetchall()
+
+def get_changes(req_id: int, limit: int = 50):
+    with conn() as c:
+        return c.execute(
+            "SELECT * FROM request_changes WHERE request_id=? ORDER BY seq DESC LIMIT ?",
+            (req_id, limit),
+        ).fetchall()
+
+# Вес колонок в bm25: назначение важнее автора, автор — комментариев
+FTS_WEIGHTS = (10.0, 3.0, 1.0)
+
+def fts_query(text: str) -> str:
+    # из пользовательского текста — только слова, каждое как префикс: "кофемаш"* "ремонт"*
+    words = re.findall(r"\w+", (text or "").lower())
+    return " ".join(f'"{w}"*' for w in words[:8])
+
+def search_requests(text: str, limit: int = 5, offset: int = 0, author_id: Optional[int] = None):
+    q = fts_query(text)
+    if not q:
+        return []
+    sql = f"""
+        SELECT r.id, r.title, r.amount, r.status, r.author_name, r.created_at, r.decision_at,
+               snippet(requests_fts, 2, '«', '»', '…', 8) AS comment_hit
+        FROM requests_fts
+        JOIN requests r ON r.id = requests_fts.rowid
+        WHERE requests_fts MATCH ?
+          {"AND r.author_tg_id = ?" if author_id is not None else ""}
+        ORDER BY bm25(requests_fts, {", ".join(str(w) for w in FTS_WEIGHTS)}), r.id DESC
+        LIMIT ? OFFSET ?
+    """
+    args = [q] + ([author_id] if author_id is not None else []) + [limit, offset]
+    with conn() as c:
+        return c.execute(sql, args).fetchall()
+
+def consumer_offset(c, consumer: str) -> int:
+    r = c.execute("SELECT seq FROM consumer_offsets WHERE consumer=?", (consumer,)).fetchone()
+    return int(r["seq"]) if r else 0
+
+def set_consumer_offset(c, consumer: str, seq: int):
+    c.execute(
+        """
+        INSERT INTO consumer_offsets(consumer, seq, updated_at) VALUES (?, ?, datetime('now'))
+        ON CONFLICT(consumer) DO UPDATE SET seq = MAX(seq, excluded.seq), updated_at = excluded.updated_at
+        """,
+        (consumer, int(seq)),
+    )
+
+def save_admin_cards(req_id: int, cards):
+    with conn() as c:
+        c.executemany(
+            "INSERT OR REPLACE INTO admin_cards(request_id, admin_chat_id, message_id) VALUES (?,?,?)",
+            [(req_id, int(chat_id), int(message_id)) for chat_id, message_id in cards],
+        )
+        c.commit()
+
+def get_admin_cards(req_id: int):
+    with conn() as c:
+        return c.execute(
+            "SELECT admin_chat_id, message_id, kind FROM admin_cards WHERE request_id=?",
+            (req_id,),
+        ).fetchall()
+
+def save_digest_cards(admin_chat_id: int, message_id: int, req_ids):
+    with conn() as c:
+        c.executemany(
+            "INSERT OR REPLACE INTO admin_cards(request_id, admin_chat_id, message_id, kind) VALUES (?,?,?,'digest')",
+            [(int(r), int(admin_chat_id), int(message_id)) for r in req_ids],
+        )
+        c.commit()
+
+def digest_message_requests(admin_chat_id: int, message_id: int):
+    with conn() as c:
+        return c.execute(
+            """
+            SELECT r.*
+            FROM admin_cards a
+            JOIN requests r ON r.id = a.request_id
+            WHERE a.admin_chat_id = ? AND a.message_id = ? AND a.kind = 'digest'
+            ORDER BY r.id
+            """,
+            (admin_chat_id, message_id),
+        ).fetchall()
+
+def get_admin_settings(admin_chat_id: int):
+    with conn() as c:
+        return c.execute("SELECT * FROM admin_settings WHERE admin_chat_id=?", (admin_chat_id,)).fetchone()
+
+def set_notify_mode(admin_chat_id: int, mode: str, minutes: Optional[int] = None):
+    with conn() as c:
+        c.execute(
+            """
+            INSERT INTO admin_settings(admin_chat_id, notify_mode, digest_minutes, updated_at)
+            VALUES (?, ?, COALESCE(?, 15), datetime('now'))
+            ON CONFLICT(admin_chat_id) DO UPDATE SET
+              notify_mode = excluded.notify_mode,
+              digest_minutes = COALESCE(?, digest_minutes),
+              updated_at = excluded.updated_at
+            """,
+            (admin_chat_id, mode, minutes, minutes),
+        )
+        c.commit()
+
+def queue_digest(req_id: int, admin_ids):
+    # новая заявка: тем, кто в режиме digest, — в очередь сводки; возвращает тех, кому слать сразу
+    ids = [int(a) for a in admin_ids]
+    if not ids:
+        return []
+    with conn() as c:
+        digest = {r["admin_chat_id"] for r in c.execute(
+            f"SELECT admin_chat_id FROM admin_settings WHERE notify_mode='digest' AND admin_chat_id IN ({','.join('?' * len(ids))})",
+            ids,
+        )}
+        if digest:
+            c.executemany(
+                "INSERT OR IGNORE INTO digest_queue(admin_chat_id, request_id) VALUES (?, ?)",
+                [(a, req_id) for a in sorted(digest)],
+            )
+            c.commit()
+        return [a for a in ids if a not in digest]
+
+def due_digests():
+    # окно копится с самой старой заявки в очереди; вернувшимся в instant досылаем сразу
+    with conn() as c:
+        return [r["admin_chat_id"] for r in c.execute(
+            """
+            SELECT q.admin_chat_id
+            FROM digest_queue q
+            LEFT JOIN admin_settings s ON s.admin_chat_id = q.admin_chat_id
+            GROUP BY q.admin_chat_id
+            HAVING COALESCE(MAX(s.notify_mode), 'instant') != 'digest'
+                OR MIN(q.queued_at) <= datetime('now', printf('-%d minutes', MAX(s.digest_minutes)))
+            """
+        )]
+
+def digest_batch(admin_chat_id: int, limit: int):
+    # -> (открытые заявки из очереди, сколько их всего, seq, до которого очередь можно подтвердить)
+    with conn() as c:
+        upto = c.execute(
+            "SELECT MAX(seq) AS seq FROM digest_queue WHERE admin_chat_id=?", (admin_chat_id,)
+        ).fetchone()["seq"] or 0
+        rows = c.execute(
+            """
+            SELECT r.*
+            FROM digest_queue q
+            JOIN requests r ON r.id = q.request_id
+            WHERE q.admin_chat_id = ? AND q.seq <= ? AND r.status IN ('new','rework')
+            ORDER BY q.seq
+            """,
+            (admin_chat_id, upto),
+        ).fetchall()
+        return rows[:limit], len(rows), upto
+
+def ack_digest(admin_chat_id: int, upto_seq: int):
+    with conn() as c:
+        c.execute("DELETE FROM digest_queue WHERE admin_chat_id=? AND seq<=?", (admin_chat_id, upto_seq))
+        c.commit()
+
+def load_fsm_states():
+    with conn() as c:
+        return c.execute("SELECT key, state, data FROM fsm_states").fetchall()
+
+def save_fsm_states(upserts, deletes):
+    with conn() as c:
+        c.executemany(
+            """
+            INSERT INTO fsm_states(key, state, data, updated_at) VALUES (?, ?, ?, datetime('now'))
+            ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+            """,
+            upserts,
+        )
+        c.executemany("DELETE FROM fsm_states WHERE key = ?", [(k,) for k in deletes])
+        c.commit()
@@ -0,0 +1,56 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+from . import adb
+
+log = logging.getLogger(__name__)
+
+DIGEST_TICK = 30.0
+# больше в одну сводку не кладём (лимит текста и кнопок); остальное — через /pending
+DIGEST_MAX = 15
+
+# send(admin_id, rows, total) -> доставлено ли; рендер сводки живёт в main рядом с карточкой
+Send = Callable[[int, list, int], Awaitable[bool]]
+
+# Сводки новых заявок для админов в режиме digest. Очередь и время в SQLite (digest_queue),
+# поэтому после рестарта воркер просто продолжает с того, что накопилось.
+class DigestWorker:
+    def __init__(self, send: Send, tick: float = DIGEST_TICK):
+        self.send = send
+        self.tick = tick
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def flush(self, admin_id: int) -> int:
+        rows, total, upto = await adb.digest_batch(admin_id, DIGEST_MAX)
+        if rows and not await self.send(admin_id, rows, total):
+            # не доставили — очередь не трогаем, повторим на следующем тике
+            return 0
+        if upto:
+            await adb.ack_digest(admin_id, upto)
+        return len(rows)
+
+    async def _run(self):
+        while True:
+            try:
+                for admin_id in await adb.due_digests():
+                    n = await self.flush(admin_id)
+                    if n:
+                        log.info("digest with %d requests sent to %s", n, admin_id)
+            except Exception:
+                log.exception("digest tick failed")
+            await asyncio.sleep(self.tick)
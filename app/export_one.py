@@ -1,12 +1,11 @@
-import os
-import sqlite3
-import gspread
-from google.oauth2.service_account import Credentials
-from gspread_formatting import format_cell_range, CellFormat, TextFormat
-
-DB = "/opt/services/paybot/data/db.sqlite3"
-SA = "/opt/services/paybot/secrets/google_sa.json"
-SPREADSHEET_ID = os.environ.get("GSHEET_ID", "").strip()
+import sys
+import json
+import hashlib
+from . import db
+from . import aggregates
+from . import migrations
+from .sheets_backend import Block, GspreadBackend, SPREADSHEET_ID
+from .quota import GOVERNOR
 
 PAYMENT_LABELS = {"cash": "Нал", "bank": "Безнал", "bizcard": "Бизнес-карта"}
 BUDGET_LABELS = {
@@ -22,117 +21,304 @@ BUDGET_LABELS = {
 
 HEADER = ["Дата","№","Автор","За что платим","Сумма","Оплата","Статья","Статус","Кто решил","Комментарий решения"]
 
-def conn():
-    c = sqlite3.connect(DB)
-    c.row_factory = sqlite3.Row
-    return c
+TOTALS_MARK = "----- ИТОГО -----"
+TOTALS_ROWS = 3
 
 def month_sheet_title(ts: str) -> str:
     y, m, _ = ts.split(" ", 1)[0].split("-")
     return f"{int(m):02d}.{y}"
 
-def ensure_sheet(sh, title: str):
-    try:
-        return sh.worksheet(title)
-    except Exception:
-        ws = sh.add_worksheet(title=title, rows=2000, cols=20)
-        ws.append_row(HEADER)
-        return ws
-
-def strip_totals(ws):
-    values = ws.get_all_values()
-    if not values:
-        return
-    rows_to_delete = []
-    for idx, row in enumerate(values, start=1):
-        if len(row) >= 4 and "ИТОГО" in (row[3] or ""):
-            rows_to_delete.append(idx)
-    for r in reversed(rows_to_delete):
-        ws.delete_rows(r)
+def ensure_sheet(backend, title: str):
+    if backend.open_month_sheet(title, HEADER):
+        save_totals_row(title, 2)
+
+# Блок ИТОГО всегда стоит сразу под данными; его строка хранится локально в sheet_totals,
+# чтобы не скачивать лист целиком. Сверяемся одной ячейкой, при расхождении ищем по колонке D.
+def cell_value(backend, title: str, a1: str) -> str:
+    values = backend.read_range(title, a1)
+    return (values[0][0] if values and values[0] else "") or ""
+
+def locate_totals(backend, title: str) -> int:
+    col = [r[0] if r else "" for r in backend.read_range(title, "D:D")]
+    for idx, v in enumerate(col, start=1):
+        if "ИТОГО" in (v or ""):
+            return idx
+    return len(col) + 1
+
+def totals_row(backend, title: str) -> int:
+    with db.conn() as c:
+        r = c.execute("SELECT totals_row, planned_row FROM sheet_totals WHERE sheet_title = ?", (title,)).fetchone()
+    if r and r["planned_row"] is not None:
+        # прошлый экспорт упал между записью и фиксацией: ИТОГО на плановом месте = запись прошла
+        applied = cell_value(backend, title, f"D{r['planned_row']}") == TOTALS_MARK
+        resolve_plan(title, applied)
+        if applied:
+            return int(r["planned_row"])
+    if r and cell_value(backend, title, f"D{r['totals_row']}") in (TOTALS_MARK, ""):
+        return int(r["totals_row"])
+    return locate_totals(backend, title)
+
+def save_totals_row(title: str, row: int):
+    with db.conn() as c:
+        c.execute("""
+            INSERT INTO sheet_totals(sheet_title, totals_row) VALUES (?, ?)
+            ON CONFLICT(sheet_title) DO UPDATE SET totals_row = excluded.totals_row, planned_row = NULL
+        """, (title, row))
+        c.commit()
+
+# Индекс заявка → строка листа пишется в две фазы: план до batch_update, подтверждение после.
+def save_plan(title: str, planned_row: int, new_rows):
+    with db.conn() as c:
+        c.executemany("""
+            INSERT OR REPLACE INTO sheet_rows(request_id, sheet_title, row_number, content_hash, confirmed)
+            VALUES (?, ?, ?, ?, 0)
+        """, [(rid, title, row, h) for rid, row, h in new_rows])
+        c.execute("""
+            INSERT INTO sheet_totals(sheet_title, totals_row, planned_row) VALUES (?, ?, ?)
+            ON CONFLICT(sheet_title) DO UPDATE SET planned_row = excluded.planned_row
+        """, (title, planned_row, planned_row))
+        c.commit()
+
+def resolve_plan(title: str, applied: bool, updated_hashes=()):
+    with db.conn() as c:
+        if applied:
+            c.execute("UPDATE sheet_rows SET confirmed = 1 WHERE sheet_title = ? AND confirmed = 0", (title,))
+            c.executemany("UPDATE sheet_rows SET content_hash = ? WHERE request_id = ?",
+                          [(h, rid) for rid, h in updated_hashes])
+            c.execute("""
+                UPDATE sheet_totals SET totals_row = planned_row, planned_row = NULL
+                WHERE sheet_title = ? AND planned_row IS NOT NULL
+            """, (title,))
+        else:
+            c.execute("DELETE FROM sheet_rows WHERE sheet_title = ? AND confirmed = 0", (title,))
+            c.execute("UPDATE sheet_totals SET planned_row = NULL WHERE sheet_title = ?", (title,))
+        c.commit()
 
 def compute_totals(year: str, month2: str):
-    with conn() as c:
-        rows = c.execute("""
-            SELECT status, COUNT(*) as cnt, COALESCE(SUM(amount), 0) as s
-            FROM requests
-            WHERE status IN ('approved','rejected')
-              AND decision_at IS NOT NULL
-              AND strftime('%Y', decision_at) = ?
-              AND strftime('%m', decision_at) = ?
-            GROUP BY status
-        """, (year, month2)).fetchall()
-    by = {r["status"]: (int(r["cnt"]), float(r["s"])) for r in rows}
+    by = aggregates.month_status_totals(year, month2)
     a_cnt, a_sum = by.get("approved", (0, 0.0))
     r_cnt, r_sum = by.get("rejected", (0, 0.0))
     return a_cnt, a_sum, r_cnt, r_sum
 
-def append_totals(ws, year: str, month2: str):
+def totals_values(year: str, month2: str):
     a_cnt, a_sum, r_cnt, r_sum = compute_totals(year, month2)
-    values = ws.get_all_values()
-    start_row = len(values) + 1
+    return [
+        ["","","",TOTALS_MARK,"","","","","",""],
+        ["","","","ИТОГО согласовано", float(a_sum),"","","","", f"кол-во: {a_cnt}"],
+        ["","","","ИТОГО отклонено",  float(r_sum),"","","","", f"кол-во: {r_cnt}"],
+    ]
 
-    ws.append_row(["","","","----- ИТОГО -----","","","","","",""])
-    ws.append_row(["","","","ИТОГО согласовано", float(a_sum),"","","","", f"кол-во: {a_cnt}"])
-    ws.append_row(["","","","ИТОГО отклонено",  float(r_sum),"","","","", f"кол-во: {r_cnt}"])
+def write_block(backend, title: str, start: int, appends, year: str, month2: str, updates=()):
+    # Новые строки встают на место старого ИТОГО, ИТОГО переезжает под них,
+    # изменённые строки перезаписываются по своему номеру — всё одной записью.
+    new_totals = start + len(appends)
+    blocks = [Block(row_number, [values]) for row_number, values in updates]
+    if appends:
+        blocks.append(Block(start, appends))
+    blocks.append(Block(new_totals, totals_values(year, month2), bold=True))
+    backend.write(title, blocks)
+    return new_totals
 
-    end_row = start_row + 2
-    bold = CellFormat(textFormat=TextFormat(bold=True))
-    format_cell_range(ws, f"A{start_row}:J{end_row}", bold)
+def rewrite_totals(backend, title: str, year: str, month2: str):
+    save_totals_row(title, write_block(backend, title, totals_row(backend, title), [], year, month2))
 
-def main():
-    if not SPREADSHEET_ID:
-        raise SystemExit("GSHEET_ID is empty")
+def open_backend():
+    return GspreadBackend.from_service_account()
+
+def sheet_row(row):
+    pay = (row["payment_type"] or "bank").strip()
+    bud = (row["budget_category"] or "other").strip()
+    return [
+        row["created_at"],
+        row["id"],
+        row["author_name"],
+        row["title"],
+        float(row["amount"]),
+        PAYMENT_LABELS.get(pay, pay),
+        BUDGET_LABELS.get(bud, bud),
+        row["status"],
+        row["decision_by_name"] or "",
+        row["decision_comment"] or "",
+    ]
+
+# Работу экспорт берёт из журнала request_changes начиная со своего seq в consumer_offsets.
+# Выгружаются решённые заявки и те, что уже есть на листе (например, вернулись в rework).
+CONSUMER = "sheets"
+
+def changed_rows(c, after_seq: int, upto_seq: int):
+    return c.execute("""
+        SELECT r.*, s.sheet_title AS indexed_sheet
+        FROM requests r
+        LEFT JOIN sheet_rows s ON s.request_id = r.id
+        WHERE r.id IN (SELECT request_id FROM request_changes WHERE seq > ? AND seq <= ?)
+          AND (r.status IN ('approved','rejected') OR s.request_id IS NOT NULL)
+        ORDER BY r.decision_at ASC
+    """, (after_seq, upto_seq)).fetchall()
+
+def target_sheet(row) -> str:
+    if row["status"] in ("approved", "rejected") or not row["indexed_sheet"]:
+        return month_sheet_title(row["decision_at"] or row["created_at"])
+    return row["indexed_sheet"]
+
+def row_hash(values) -> str:
+    return hashlib.sha1(json.dumps(values, ensure_ascii=False).encode("utf-8")).hexdigest()
 
-    creds = Credentials.from_service_account_file(
-        SA,
-        scopes=["https://www.googleapis.com/auth/spreadsheets"],
-    )
-    gc = gspread.authorize(creds)
-    sh = gc.open_by_key(SPREADSHEET_ID)
+def write_sheet_rows(backend, title: str, rows):
+    ensure_sheet(backend, title)
+    m, y = title.split(".")
+    start = totals_row(backend, title)
 
-    with conn() as c:
-        row = c.execute("""
+    ids = [r["id"] for r in rows]
+    with db.conn() as c:
+        known = {
+            k["request_id"]: k
+            for k in c.execute(
+                f"SELECT * FROM sheet_rows WHERE sheet_title = ? AND request_id IN ({','.join('?' * len(ids))})",
+                [title, *ids],
+            )
+        }
+
+    appends, planned, updates, updated_hashes = [], [], [], []
+    for r in rows:
+        values = sheet_row(r)
+        h = row_hash(values)
+        k = known.get(r["id"])
+        if k is None:
+            planned.append((r["id"], start + len(appends), h))
+            appends.append(values)
+        elif k["content_hash"] != h:
+            updates.append((int(k["row_number"]), values))
+            updated_hashes.append((r["id"], h))
+
+    if not appends and not updates:
+        return
+
+    save_plan(title, start + len(appends), planned)
+    write_block(backend, title, start, appends, y, m, updates)
+    resolve_plan(title, True, updated_hashes)
+
+def mark_exported(c, ids):
+    c.executemany("UPDATE requests SET exported_to_sheets = 1 WHERE id = ?", [(i,) for i in ids])
+
+def export_next(backend):
+    with db.conn() as c:
+        offset = db.consumer_offset(c, CONSUMER)
+        while True:
+            ch = c.execute("SELECT seq FROM request_changes WHERE seq > ? ORDER BY seq LIMIT 1", (offset,)).fetchone()
+            if not ch:
+                return None
+            seq = ch["seq"]
+            rows = changed_rows(c, offset, seq)
+            if rows:
+                write_sheet_rows(backend, target_sheet(rows[0]), rows)
+            with c:
+                mark_exported(c, [r["id"] for r in rows])
+                db.set_consumer_offset(c, CONSUMER, seq)
+            if rows:
+                return rows[0]["id"]
+            offset = seq
+
+def export_pending(backend):
+    # Все изменения из журнала разом: по одной записи на лист (строки + ИТОГО).
+    # Если какой-то лист не записался, seq не двигаем: уже записанные строки при повторе
+    # отсеются по хэшу в sheet_rows и повторной записи не вызовут.
+    with db.conn() as c:
+        offset = db.consumer_offset(c, CONSUMER)
+        last = int(c.execute("SELECT COALESCE(MAX(seq), 0) FROM request_changes").fetchone()[0])
+        if last <= offset:
+            return []
+
+        by_sheet = {}
+        for row in changed_rows(c, offset, last):
+            by_sheet.setdefault(target_sheet(row), []).append(row)
+
+        written = []
+        error = None
+        for title, rows in by_sheet.items():
+            try:
+                write_sheet_rows(backend, title, rows)
+            except Exception as e:
+                error = e
+                break
+            written.extend(r["id"] for r in rows)
+
+        with c:
+            mark_exported(c, written)
+            if error is None:
+                db.set_consumer_offset(c, CONSUMER, last)
+        if error is not None:
+            raise error
+        return written
+
+def month_rows(year: str, month2: str):
+    with db.conn() as c:
+        yield from c.execute("""
             SELECT *
             FROM requests
             WHERE status IN ('approved','rejected')
-              AND exported_to_sheets = 0
+              AND decision_at >= ? AND decision_at < ?
             ORDER BY decision_at ASC
-            LIMIT 1
-        """).fetchone()
-
-        if not row:
-            print("nothing_to_export")
-            return
-
-        sheet_ts = row["decision_at"] or row["created_at"]
-        ws = ensure_sheet(sh, month_sheet_title(sheet_ts))
-        strip_totals(ws)
-
-        pay = (row["payment_type"] or "bank").strip()
-        bud = (row["budget_category"] or "other").strip()
-        pay_label = PAYMENT_LABELS.get(pay, pay)
-        bud_label = BUDGET_LABELS.get(bud, bud)
-
-        ws.append_row([
-            row["created_at"],
-            row["id"],
-            row["author_name"],
-            row["title"],
-            float(row["amount"]),
-            pay_label,
-            bud_label,
-            row["status"],
-            row["decision_by_name"] or "",
-            row["decision_comment"] or "",
-        ])
-
-        c.execute("UPDATE requests SET exported_to_sheets = 1 WHERE id = ?", (row["id"],))
-        c.commit()
+        """, db.month_range(year, month2))
+
+def rebuild_month(backend, year: str, month2: str) -> int:
+    # Лист месяца целиком из SQLite: шапка, строки, ИТОГО и затирка хвоста — одной записью.
+    # Индекс sheet_rows и строка ИТОГО для листа переписываются под новую раскладку.
+    title = f"{int(month2):02d}.{int(year)}"
+    ensure_sheet(backend, title)
+    old_end = len(backend.read_range(title, "D:D"))
+    with db.conn() as c:
+        r = c.execute("SELECT totals_row FROM sheet_totals WHERE sheet_title = ?", (title,)).fetchone()
+    if r:
+        old_end = max(old_end, int(r["totals_row"]) + TOTALS_ROWS - 1)
+
+    values, index = [], []
+    for row in month_rows(year, month2):
+        v = sheet_row(row)
+        index.append((row["id"], title, 2 + len(values), row_hash(v)))
+        values.append(v)
+
+    totals_at = 2 + len(values)
+    new_end = totals_at + TOTALS_ROWS - 1
+    blocks = [
+        Block(1, [HEADER] + values),
+        Block(totals_at, totals_values(year, month2), bold=True),
+    ]
+    if old_end > new_end:
+        blocks.append(Block(new_end + 1, [[""] * len(HEADER)] * (old_end - new_end)))
+    backend.write(title, blocks)
+
+    with db.conn() as c:
+        with c:
+            c.execute("DELETE FROM sheet_rows WHERE sheet_title = ?", (title,))
+            c.executemany("""
+                INSERT OR REPLACE INTO sheet_rows(request_id, sheet_title, row_number, content_hash, confirmed)
+                VALUES (?, ?, ?, ?, 1)
+            """, index)
+            c.execute("""
+                INSERT INTO sheet_totals(sheet_title, totals_row) VALUES (?, ?)
+                ON CONFLICT(sheet_title) DO UPDATE SET totals_row = excluded.totals_row, planned_row = NULL
+            """, (title, totals_at))
+            mark_exported(c, [i[0] for i in index])
+    return len(values)
 
-        y, m, _ = (row["decision_at"] or row["created_at"]).split(" ", 1)[0].split("-")
-        append_totals(ws, y, m)
+def main():
+    if not SPREADSHEET_ID:
+        raise SystemExit("GSHEET_ID is empty")
+
+    migrations.migrate()
+    before = GOVERNOR.snapshot()
+    backend = open_backend()
+    if "--all" in sys.argv[1:]:
+        ids = export_pending(backend)
+    else:
+        req_id = export_next(backend)
+        ids = [] if req_id is None else [req_id]
+    print(f"sheets_calls:{GOVERNOR.spent_since(before)}")
+    if not ids:
+        print("nothing_to_export")
+        return
 
-        print(f"exported:{row['id']}")
+    print(f"exported:{','.join(str(i) for i in ids)}")
 
 if __name__ == "__main__":
     main()
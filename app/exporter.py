@@ -1,16 +1,98 @@
-import os
-import subprocess
-
-PYTHON = "/opt/services/paybot/venv/bin/python"
-SCRIPT = "/opt/services/paybot/app/export_one.py"
-
-def export_one():
-    env = os.environ.copy()
-    if not env.get("GSHEET_ID"):
-        raise RuntimeError("GSHEET_ID is not set")
-
-    subprocess.run(
-        [PYTHON, SCRIPT],
-        env=env,
-        check=True,
-    )
+import asyncio
+import logging
+from typing import Optional, Sequence, Set, Tuple
+
+from aiogram import Bot
+
+from . import db
+from . import export_one
+from .quota import GOVERNOR
+
+log = logging.getLogger(__name__)
+
+# Экспорт в Google Sheets внутри процесса бота: решения ставят задачу в очередь,
+# воркер держит открытый бэкенд таблицы (gspread-клиент) и отчитывается в чат админа.
+class ExportWorker:
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._backend = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            # догоняем то, что не выгрузилось до рестарта
+            self.enqueue(None, None)
+
+    async def stop(self, timeout: float = 30.0):
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            log.warning("export queue not drained in %.0fs, %d jobs left", timeout, self.queue.qsize())
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def enqueue(self, chat_id: Optional[int], req_id: Optional[int]):
+        self.queue.put_nowait((chat_id, (req_id,) if req_id else ()))
+
+    def enqueue_batch(self, chat_id: Optional[int], req_ids: Sequence[int]):
+        # пачка решений — одна задача и один проход экспорта
+        self.queue.put_nowait((chat_id, tuple(req_ids)))
+
+    def backend(self):
+        if self._backend is None:
+            self._backend = export_one.open_backend()
+        return self._backend
+
+    def use_backend(self, backend):
+        self._backend = backend
+
+    def _drain(self, req_ids: Tuple[int, ...]) -> Set[int]:
+        before = GOVERNOR.snapshot()
+        try:
+            ids = export_one.export_pending(self.backend())
+        finally:
+            spent = GOVERNOR.spent_since(before)
+            if spent:
+                log.info("sheets calls spent: %s", spent)
+        if ids:
+            log.info("exported %d rows", len(ids))
+        return db.exported_ids(req_ids) if req_ids else set()
+
+    async def _report(self, chat_id: int, text: str):
+        try:
+            await self.bot.send_message(chat_id, text)
+        except Exception:
+            log.exception("failed to report export result to %s", chat_id)
+
+    async def _run(self):
+        while True:
+            chat_id, req_ids = await self.queue.get()
+            what = f"Заявка №{req_ids[0]}" if len(req_ids) == 1 else f"Заявки ({len(req_ids)} шт.)"
+            try:
+                try:
+                    done = await asyncio.to_thread(self._drain, req_ids)
+                except Exception as e:
+                    # клиент мог протухнуть — переавторизуемся на следующей задаче
+                    self._backend = None
+                    log.exception("export failed")
+                    if chat_id:
+                        await self._report(chat_id, f"{what}: решение сохранено, но экспорт упал: {e}")
+                    continue
+                if chat_id and req_ids:
+                    if len(done) == len(req_ids):
+                        await self._report(chat_id, f"{what}: выгружено в Google Sheets.")
+                    elif len(req_ids) == 1:
+                        await self._report(chat_id, f"{what}: не выгружена — нечего экспортировать.")
+                    else:
+                        missed = ", ".join(f"№{i}" for i in req_ids if i not in done)
+                        await self._report(chat_id, f"{what}: выгружено {len(done)}, не выгружены {missed}.")
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,76 @@
+import asyncio
+import json
+import logging
+from typing import Any, Dict, Optional, Set
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+
+from . import adb
+
+log = logging.getLogger(__name__)
+
+# FSM в SQLite: чтение из кэша в памяти, запись отложенная — все изменения за один
+# проход event loop уходят одной транзакцией. Диалоги переживают рестарт сервиса.
+class SQLiteStorage(BaseStorage):
+    def __init__(self):
+        self._states: Dict[str, Optional[str]] = {}
+        self._data: Dict[str, Dict[str, Any]] = {}
+        self._dirty: Set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(x) for x in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            getattr(key, "business_connection_id", None), key.destiny,
+        ))
+
+    async def load(self):
+        for r in await adb.load_fsm_states():
+            self._states[r["key"]] = r["state"]
+            self._data[r["key"]] = json.loads(r["data"] or "{}")
+
+    def _touch(self, k: str):
+        self._dirty.add(k)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush())
+
+    async def _flush(self):
+        while self._dirty:
+            keys, self._dirty = self._dirty, set()
+            upserts, deletes = [], []
+            for k in keys:
+                state, data = self._states.get(k), self._data.get(k) or {}
+                if state is None and not data:
+                    deletes.append(k)
+                else:
+                    upserts.append((k, state, json.dumps(data, ensure_ascii=False, default=str)))
+            try:
+                await adb.save_fsm_states(upserts, deletes)
+            except Exception:
+                log.exception("fsm flush failed, will retry with the next change")
+                self._dirty |= keys
+                return
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self._key(key)
+        self._states[k] = state.state if isinstance(state, State) else state
+        self._touch(k)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._states.get(self._key(key))
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k = self._key(key)
+        self._data[k] = dict(data)
+        self._touch(k)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict(self._data.get(self._key(key)) or {})
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._dirty:
+            await self._flush()
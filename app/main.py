@@ -3,16 +3,24 @@ import asyncio
 from typing import Optional
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, CallbackQuery
-from aiogram.filters import Command
+from aiogram.types import Message, CallbackQuery, FSInputFile, InlineKeyboardMarkup
+from aiogram.filters import Command, CommandObject
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
 
-from . import db
-from .exporter import export_one
+from . import adb
+from . import migrations
+from . import webhook
+from . import middleware
+from . import month_export
+from . import reports
+from . import attachments
+from .exporter import ExportWorker
+from .digest import DigestWorker
+from .fsm_storage import SQLiteStorage
+from .notify import FanOut, Delivery
 
 TOKEN_FILE = "/opt/services/paybot/secrets/telegram_token.txt"
 
@@ -102,11 +110,7 @@ def build_edit_menu(req_id: int):
     kb.adjust(2,2,1)
     return kb.as_markup()
 
-async def notify_admins(bot: Bot, req_id: int):
-    row = db.get_request(req_id)
-    if not row:
-        return
-
+def card_text(row) -> str:
     pay = PAYMENT_LABELS.get((row["payment_type"] or "").strip(), row["payment_type"] or "")
     bud = BUDGET_LABELS.get((row["budget_category"] or "").strip(), row["budget_category"] or "")
     text = (
@@ -118,33 +122,388 @@ async def notify_admins(bot: Bot, req_id: int):
         f"За что платим: {row['title']}\n"
         f"Статус: {row['status']}"
     )
+    if row["status"] in ("approved","rejected") and row["decision_by_name"]:
+        text += f"\nРешил: {row['decision_by_name']}"
+        if row["decision_comment"]:
+            text += f"\nКомментарий: {row['decision_comment']}"
+    return text
+
+MAX_ATTACHMENTS = 20
+
+async def notify_admins(fanout: FanOut, req_id: int) -> list[Delivery]:
+    # админам в режиме digest заявка уходит в очередь сводки, остальным — карточка сразу
+    instant = await adb.queue_digest(req_id, admins())
+    if not instant:
+        return []
+    row = await adb.get_request(req_id)
+    if not row:
+        return []
+
+    text = card_text(row)
+    steps = [lambda b, aid: b.send_message(aid, text, reply_markup=build_admin_kb(req_id))]
+    steps += attachments.send_steps(await adb.get_attachments(req_id), f"Приложение к заявке №{req_id}")
+
+    deliveries = await fanout.broadcast(instant, steps)
+    await adb.save_admin_cards(req_id, [(d.chat_id, d.results[0].message_id) for d in deliveries if d.results])
+    return deliveries
+
+def digest_text(rows, total: int) -> str:
+    lines = [f"Новые заявки: {total}"]
+    for r in rows:
+        bud = BUDGET_LABELS.get(r["budget_category"] or "", r["budget_category"] or "")
+        clip = "📎 " if r["attachment_file_id"] else ""
+        lines.append(f"\n№{r['id']} · {nice_amount(float(r['amount']))} · {bud}\n{clip}{r['title']} — {r['author_name']}")
+    if total > len(rows):
+        lines.append(f"\n…и ещё {total - len(rows)}, все — в /pending")
+    return "\n".join(lines)
+
+def build_digest_kb(rows):
+    kb = InlineKeyboardBuilder()
+    sizes = []
+    for r in rows:
+        kb.button(text=f"✅ №{r['id']}", callback_data=f"decide:{r['id']}:approved")
+        kb.button(text="❌", callback_data=f"decide:{r['id']}:rejected")
+        kb.button(text="✏️", callback_data=f"edit:{r['id']}")
+        sizes.append(3)
+        if r["attachment_file_id"]:
+            kb.button(text="📎", callback_data=f"att:{r['id']}")
+            sizes[-1] += 1
+    kb.adjust(*sizes)
+    return kb.as_markup()
 
-    for aid in admins():
-        try:
-            await bot.send_message(aid, text, reply_markup=build_admin_kb(req_id))
-            file_id = row["attachment_file_id"]
-            kind = (row["attachment_kind"] or "").strip()
-            if file_id:
-                caption = f"Приложение к заявке №{row['id']}"
-                if kind == "photo":
-                    await bot.send_photo(aid, photo=file_id, caption=caption)
-                else:
-                    await bot.send_document(aid, document=file_id, caption=caption)
-        except Exception:
-            pass
+def drop_request_buttons(markup, req_id: int):
+    # с карточки уходят все кнопки, из сводки — только кнопки этой заявки
+    if not markup:
+        return None
+    rows = [[b for b in row if (b.callback_data or "").split(":")[1:2] != [str(req_id)]] for row in markup.inline_keyboard]
+    rows = [row for row in rows if row]
+    return InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+
+async def send_digest(fanout: FanOut, admin_id: int, rows, total: int) -> bool:
+    text, kb = digest_text(rows, total), build_digest_kb(rows)
+    d = await fanout.deliver(admin_id, [lambda b, aid: b.send_message(aid, text, reply_markup=kb)])
+    if d.ok:
+        # как и карточки: после решения другим админом кнопки заявки со сводки снимаются
+        await adb.save_digest_cards(admin_id, d.results[0].message_id, [r["id"] for r in rows])
+    return d.ok
+
+async def refresh_admin_cards(fanout: FanOut, req_id: int, row=None) -> list[Delivery]:
+    # Карточка у всех админов показывает актуальный статус; после решения кнопки снимаются,
+    # при доработке остаются — заявку ещё можно согласовать/отклонить.
+    # row — строка, которую вернула запись (RETURNING); без неё перечитываем.
+    row = row or await adb.get_request(req_id)
+    if not row:
+        return []
+    cards = await adb.get_admin_cards(req_id)
+    message_ids = {int(r["admin_chat_id"]): int(r["message_id"]) for r in cards if r["kind"] != "digest"}
+    digests = {int(r["admin_chat_id"]): int(r["message_id"]) for r in cards if r["kind"] == "digest"}
+
+    text = card_text(row)
+    kb = build_admin_kb(req_id) if row["status"] in ("new","rework") else None
+    step = lambda b, aid: b.edit_message_text(text, chat_id=aid, message_id=message_ids[aid], reply_markup=kb)
+    jobs = [fanout.broadcast(message_ids.keys(), [step])] if message_ids else []
+    # в сводке остаются кнопки только тех её заявок, что ещё открыты
+    for aid, mid in digests.items():
+        still_open = [r for r in await adb.digest_message_requests(aid, mid) if r["status"] in ("new","rework")]
+        dkb = build_digest_kb(still_open) if still_open else None
+        dstep = lambda b, aid, mid=mid, dkb=dkb: b.edit_message_reply_markup(chat_id=aid, message_id=mid, reply_markup=dkb)
+        jobs.append(fanout.broadcast([aid], [dstep]))
+    return [d for ds in await asyncio.gather(*jobs) for d in ds]
+
+def pending_view(rows, has_prev: bool, has_next: bool, selected: set, ver: int = 0):
+    anchor = rows[0]["id"] - 1 if rows else 0
+    if not rows:
+        text = "Нерешённых заявок нет."
+    else:
+        lines = ["Нерешённые заявки (new/rework). Отметь нужные и реши пачкой:"]
+        for r in rows:
+            bud = BUDGET_LABELS.get(r["budget_category"] or "", r["budget_category"] or "")
+            lines.append(f"\n№{r['id']} · {nice_amount(float(r['amount']))} · {bud} · {r['status']}")
+            lines.append(f"{r['title']} — {r['author_name']}")
+        text = "\n".join(lines)
 
-async def main():
-    bot = Bot(token=read_token())
-    dp = Dispatcher(storage=MemoryStorage())
+    kb = InlineKeyboardBuilder()
+    # В кнопке — нужное состояние (1 отметить, 0 снять) и версия выбора: повтор нажатия ничего не
+    # переключает обратно, а у каждой перерисовки свой callback_data и CallbackDedup не глотает отмену.
+    for r in rows:
+        on = r["id"] in selected
+        mark = "☑️" if on else "⬜"
+        kb.button(text=f"{mark} №{r['id']} · {nice_amount(float(r['amount']))}",
+                  callback_data=f"pend:tog:{r['id']}:{anchor}:{0 if on else 1}:{ver}")
+    nav = 0
+    if has_prev:
+        kb.button(text="◀️", callback_data=f"pend:prev:{rows[0]['id']}")
+        nav += 1
+    if has_next:
+        kb.button(text="▶️", callback_data=f"pend:next:{rows[-1]['id']}")
+        nav += 1
+    actions = 0
+    if selected:
+        kb.button(text=f"✅ Согласовать ({len(selected)})", callback_data=f"pend:do:approved:{anchor}")
+        kb.button(text=f"❌ Отклонить ({len(selected)})", callback_data=f"pend:do:rejected:{anchor}")
+        kb.button(text="Снять выбор", callback_data=f"pend:clear:{anchor}")
+        actions = 3
+    if not rows and not nav:
+        return text, None
+    kb.adjust(*([1] * len(rows) + ([nav] if nav else []) + ([2, 1] if actions else [])))
+    return text, kb.as_markup()
+
+FIND_PAGE = 5
+
+def find_text(rows, query: str, page: int) -> str:
+    if not rows:
+        return f"По запросу «{query}» ничего не нашлось." if page == 0 else "Больше результатов нет."
+    lines = [f"Поиск «{query}», стр. {page + 1}:"]
+    for r in rows:
+        date = (r["decision_at"] or r["created_at"] or "")[:10]
+        lines.append(f"\n№{r['id']} · {date} · {r['status']} · {nice_amount(float(r['amount']))}")
+        lines.append(f"{r['title']} — {r['author_name']}")
+        if "«" in (r["comment_hit"] or ""):
+            lines.append(f"💬 {r['comment_hit']}")
+    return "\n".join(lines)
+
+def build_find_kb(page: int, has_next: bool):
+    if page == 0 and not has_next:
+        return None
+    kb = InlineKeyboardBuilder()
+    if page > 0:
+        kb.button(text="◀️", callback_data=f"find:{page - 1}")
+    if has_next:
+        kb.button(text="▶️", callback_data=f"find:{page + 1}")
+    return kb.as_markup()
+
+async def find_page(user_id: int, query: str, page: int):
+    # админы ищут по всем заявкам, остальные — по своим; лишняя строка = есть следующая страница
+    rows = await adb.search_requests(
+        query, limit=FIND_PAGE + 1, offset=page * FIND_PAGE,
+        author_id=None if is_admin(user_id) else user_id,
+    )
+    return find_text(rows[:FIND_PAGE], query, page), build_find_kb(page, len(rows) > FIND_PAGE)
 
+def register_handlers(dp: Dispatcher, bot: Bot, fanout: FanOut, export_worker: ExportWorker):
     @dp.message(Command("start"))
     async def start(msg: Message):
-        await msg.answer("Paybot.\n/new — создать заявку.\n/whoami — показать tg_id.")
+        text = "Paybot.\n/new — создать заявку.\n/find текст — поиск по заявкам.\n/whoami — показать tg_id."
+        if is_admin(msg.from_user.id):
+            text += "\n/pending — нерешённые заявки, решение пачкой."
+            text += "\n/notify [instant|digest N] — карточки сразу или сводкой."
+            text += "\n/export ГГГГ-ММ [csv|xlsx] — заявки за месяц файлом."
+            text += "\n/report [С [ПО]] [budget|pay|both] — суммы по статьям/типам оплаты."
+        await msg.answer(text)
 
     @dp.message(Command("whoami"))
     async def whoami(msg: Message):
         await msg.answer(f"Ваш tg_id: {msg.from_user.id}")
 
+    # Команды — до хендлеров состояний: те ловят любой текст, и команда, набранная посреди
+    # диалога, ушла бы в него (например, комментарием к решению).
+    # ---------- ADMIN EXPORT ----------
+    @dp.message(Command("export"))
+    async def export_month(msg: Message, command: CommandObject):
+        if not is_admin(msg.from_user.id):
+            await msg.answer("Не админ.")
+            return
+        args = (command.args or "").split()
+        try:
+            y, m = (int(x) for x in args[0].split("-"))
+            if not 1 <= m <= 12:
+                raise ValueError
+        except Exception:
+            await msg.answer("Формат: /export ГГГГ-ММ [csv|xlsx], например /export 2025-12 xlsx")
+            return
+        fmt = args[1].lower() if len(args) > 1 else "csv"
+        if fmt not in month_export.FORMATS:
+            await msg.answer("Формат файла: csv или xlsx.")
+            return
+
+        await msg.answer(f"Готовлю выгрузку за {m:02d}.{y}…")
+        try:
+            path, n = await asyncio.to_thread(month_export.write_month_file, str(y), f"{m:02d}", fmt)
+        except ImportError:
+            await msg.answer("Для xlsx на сервере не установлен openpyxl. Попробуй csv.")
+            return
+        try:
+            await msg.answer_document(
+                FSInputFile(path, filename=f"paybot_{y}-{m:02d}.{fmt}"),
+                caption=f"Заявки за {m:02d}.{y}: {n} шт.",
+            )
+        finally:
+            os.unlink(path)
+
+    # ---------- ADMIN REPORT ----------
+    @dp.message(Command("report"))
+    async def report(msg: Message, command: CommandObject):
+        if not is_admin(msg.from_user.id):
+            await msg.answer("Не админ.")
+            return
+        args = (command.args or "").split()
+        group = next((a.lower() for a in args if a.lower() in reports.GROUPS), "budget")
+        dates = [a for a in args if a.lower() not in reports.GROUPS]
+        try:
+            if len(dates) > 2:
+                raise ValueError
+            start, end = reports.parse_period(dates)
+        except Exception:
+            await msg.answer(
+                "Формат: /report [С [ПО]] [budget|pay|both]\n"
+                "С/ПО — ГГГГ-ММ или ГГГГ-ММ-ДД, ПО включительно; без дат — текущий месяц.\n"
+                "Например: /report 2025-10 2025-12 both"
+            )
+            return
+
+        text = reports.cached(start, end, group)
+        if text is None:
+            gen = reports.generation()
+            data = await adb.run(reports.totals, start, end, group)
+            text = reports.render(start, end, group, data)
+            reports.store(start, end, group, text, gen)
+        await msg.answer(text)
+
+    # ---------- SEARCH ----------
+    @dp.message(Command("find"))
+    async def find(msg: Message, command: CommandObject, state: FSMContext):
+        query = (command.args or "").strip()
+        if not query:
+            await msg.answer("Формат: /find текст, например /find ремонт кофемашины")
+            return
+        # запрос держим в данных FSM: в callback_data он может не влезть (64 байта)
+        await state.update_data(find_query=query)
+        text, kb = await find_page(msg.from_user.id, query, 0)
+        await msg.answer(text, reply_markup=kb)
+
+    @dp.callback_query(F.data.startswith("find:"))
+    async def find_more(cb: CallbackQuery, state: FSMContext):
+        query = (await state.get_data()).get("find_query")
+        if not query:
+            await cb.answer("Поиск устарел, повтори /find.", show_alert=True)
+            return
+        page = max(0, int(cb.data.split(":")[1]))
+        text, kb = await find_page(cb.from_user.id, query, page)
+        await cb.answer()
+        try:
+            await cb.message.edit_text(text, reply_markup=kb)
+        except Exception:
+            pass
+
+    # ---------- ADMIN PENDING (BATCH) ----------
+    async def _show_pending(target: Message, state: FSMContext, edit: bool, after: int = 0, before: Optional[int] = None):
+        rows, has_prev, has_next = await adb.pending_page(after=after, before=before)
+        data = await state.get_data()
+        selected = set(data.get("pend_sel") or [])
+        text, kb = pending_view(rows, has_prev, has_next, selected, data.get("pend_ver") or 0)
+        if not edit:
+            await target.answer(text, reply_markup=kb)
+            return
+        try:
+            await target.edit_text(text, reply_markup=kb)
+        except Exception:
+            pass
+
+    @dp.message(Command("pending"))
+    async def pending(msg: Message, state: FSMContext):
+        if not is_admin(msg.from_user.id):
+            await msg.answer("Не админ.")
+            return
+        await state.update_data(pend_sel=[])
+        await _show_pending(msg, state, edit=False)
+
+    @dp.callback_query(F.data.startswith("pend:"))
+    async def pending_action(cb: CallbackQuery, state: FSMContext):
+        if not is_admin(cb.from_user.id):
+            await cb.answer("Не админ.", show_alert=True)
+            return
+        parts = cb.data.split(":")
+        action = parts[1]
+        data = await state.get_data()
+        selected = set(data.get("pend_sel") or [])
+        ver = (data.get("pend_ver") or 0) + 1
+
+        if action == "next":
+            await cb.answer()
+            await _show_pending(cb.message, state, edit=True, after=int(parts[2]))
+            return
+        if action == "prev":
+            await cb.answer()
+            await _show_pending(cb.message, state, edit=True, before=int(parts[2]))
+            return
+        if action == "tog":
+            req_id = int(parts[2])
+            if len(parts) > 4 and parts[4] == "0":
+                selected.discard(req_id)
+            elif len(parts) > 4:
+                selected.add(req_id)
+            else:
+                selected ^= {req_id}  # кнопки, нарисованные до версии с состоянием
+            await state.update_data(pend_sel=sorted(selected), pend_ver=ver)
+            await cb.answer()
+            await _show_pending(cb.message, state, edit=True, after=int(parts[3]))
+            return
+        if action == "clear":
+            await state.update_data(pend_sel=[], pend_ver=ver)
+            await cb.answer()
+            await _show_pending(cb.message, state, edit=True, after=int(parts[3]))
+            return
+        if action != "do" or parts[2] not in ("approved","rejected"):
+            await cb.answer("Не понял.", show_alert=True)
+            return
+
+        status, after = parts[2], int(parts[3])
+        if not selected:
+            await cb.answer("Ничего не выбрано.", show_alert=True)
+            return
+        rows = await adb.decide_many(selected, status, cb.from_user.id, cb.from_user.full_name or "Админ")
+        await state.update_data(pend_sel=[], pend_ver=ver)
+        await cb.answer(f"Готово: {len(rows)}")
+        done = [r["id"] for r in rows]
+        skipped = sorted(selected - set(done))
+        text = f"Решено пачкой → {status}: {len(done)} шт."
+        if skipped:
+            text += "\nУже были решены: " + ", ".join(f"№{i}" for i in skipped)
+        if done:
+            text += "\nВыгрузка в Google Sheets поставлена в очередь."
+            export_worker.enqueue_batch(cb.message.chat.id, done)
+        await cb.message.answer(text)
+        await _show_pending(cb.message, state, edit=True, after=after)
+        await asyncio.gather(*(refresh_admin_cards(fanout, r["id"], r) for r in rows))
+
+    # ---------- ADMIN NOTIFY MODE ----------
+    @dp.message(Command("notify"))
+    async def notify_mode(msg: Message, command: CommandObject):
+        if not is_admin(msg.from_user.id):
+            await msg.answer("Не админ.")
+            return
+        args = (command.args or "").split()
+        if not args:
+            cur = await adb.get_admin_settings(msg.from_user.id)
+            if cur and cur["notify_mode"] == "digest":
+                now = f"сводка раз в {cur['digest_minutes']} мин"
+            else:
+                now = "каждая заявка сразу"
+            await msg.answer(
+                f"Сейчас: {now}.\n"
+                "/notify instant — карточка на каждую заявку\n"
+                "/notify digest [минут] — сводка раз в N минут (по умолчанию 15)"
+            )
+            return
+        mode = args[0].lower()
+        if mode == "instant":
+            await adb.set_notify_mode(msg.from_user.id, "instant")
+            await msg.answer("Ок, новые заявки буду присылать сразу. Накопленное пришлю в ближайшую минуту.")
+            return
+        if mode != "digest":
+            await msg.answer("Формат: /notify instant или /notify digest [минут]")
+            return
+        try:
+            minutes = int(args[1]) if len(args) > 1 else None
+            if minutes is not None and not 1 <= minutes <= 24 * 60:
+                raise ValueError
+        except ValueError:
+            await msg.answer("Минуты — целое число от 1 до 1440.")
+            return
+        await adb.set_notify_mode(msg.from_user.id, "digest", minutes)
+        cur = await adb.get_admin_settings(msg.from_user.id)
+        await msg.answer(f"Ок, новые заявки буду присылать сводкой раз в {cur['digest_minutes']} мин.")
+
     # ---------- USER FLOW ----------
     @dp.message(Command("new"))
     async def new(msg: Message, state: FSMContext):
@@ -201,7 +560,7 @@ async def main():
         await state.update_data(budget_category=bud)
         await state.set_state(NewRequest.attachment)
         await cb.answer("Ок")
-        await cb.message.answer("Файл/фото счёта приложишь? Если нет — напиши: нет")
+        await cb.message.answer("Приложи файлы/фото счетов (можно несколько), потом напиши: готово. Без файлов — напиши: нет")
 
     @dp.message(NewRequest.budget)
     async def budget_guard(msg: Message):
@@ -221,35 +580,49 @@ async def main():
             await msg.answer("Как оплачиваем?", reply_markup=build_pay_kb(prefix="paynew:"))
             return
 
-        attachment_file_id: Optional[str] = None
-        attachment_kind: Optional[str] = None
-
-        if msg.document:
-            attachment_file_id = msg.document.file_id
-            attachment_kind = "document"
-        elif msg.photo:
-            attachment_file_id = msg.photo[-1].file_id
-            attachment_kind = "photo"
-        else:
-            t = (msg.text or "").strip().lower()
-            if t not in ("нет", "no", "-", "неа"):
-                await msg.answer("Либо приложи файл/фото, либо напиши: нет")
+        # файлов может быть несколько (и альбомом); копим в FSM, заявку создаём по "готово"/"нет"
+        files = data.get("files") or []
+        if msg.document or msg.photo:
+            if msg.document:
+                f = ["document", msg.document.file_id, msg.document.file_unique_id]
+            else:
+                f = ["photo", msg.photo[-1].file_id, msg.photo[-1].file_unique_id]
+            if f[2] in {x[2] for x in files}:
                 return
+            if len(files) >= MAX_ATTACHMENTS:
+                await msg.answer(f"Больше {MAX_ATTACHMENTS} файлов не приложить. Напиши: готово")
+                return
+            first_of_album = not msg.media_group_id or msg.media_group_id != data.get("album")
+            await state.update_data(files=files + [f], album=msg.media_group_id)
+            # на альбом отвечаем один раз, а не на каждый файл
+            if first_of_album:
+                await msg.answer("Файл добавлен. Ещё файл — пришли, всё — напиши: готово")
+            return
+
+        t = (msg.text or "").strip().lower()
+        if t not in ("нет", "no", "-", "неа", "готово", "все", "всё", "done"):
+            await msg.answer("Приложи файл/фото или напиши: готово (без файлов — нет)")
+            return
 
-        req_id = db.create_request(
+        req_id = await adb.create_request(
             author_id=msg.from_user.id,
             author_name=(msg.from_user.full_name or "Без имени"),
             title=title,
             amount=amount,
             payment_type=payment_type,
             budget_category=budget_category,
-            attachment_file_id=attachment_file_id,
-            attachment_kind=attachment_kind,
+            attachment_file_id=None,
+            attachment_kind=None,
+            attachments=[tuple(f) for f in files],
         )
 
         await state.clear()
+        if files:
+            attachments.schedule_archive(bot, req_id)
         await msg.answer(f"Заявка №{req_id} создана и отправлена админам.")
-        await notify_admins(bot, req_id)
+        deliveries = await notify_admins(fanout, req_id)
+        if deliveries and not any(d.ok for d in deliveries):
+            await msg.answer("Внимание: ни одному админу не удалось доставить уведомление. Напиши админу напрямую.")
 
     # ---------- ADMIN DECISION ----------
     @dp.callback_query(F.data.startswith("decide:"))
@@ -261,7 +634,10 @@ async def main():
         _, rid, status = cb.data.split(":")
         req_id = int(rid)
 
-        row = db.get_request(req_id)
+        # Здесь ничего не пишется: решение фиксирует decision_comment одним условным
+        # UPDATE ... RETURNING. Чтение только для того, чтобы не спрашивать комментарий
+        # по уже закрытой заявке; гонку между кнопкой и комментарием закрывает та запись.
+        row = await adb.get_request(req_id)
         if not row:
             await cb.answer("Заявка не найдена.", show_alert=True)
             return
@@ -275,7 +651,7 @@ async def main():
         await cb.answer()
         # Блокируем мисклики: пока ждём комментарий решения, убираем кнопки с карточки
         try:
-            await cb.message.edit_reply_markup(reply_markup=None)
+            await cb.message.edit_reply_markup(reply_markup=drop_request_buttons(cb.message.reply_markup, req_id))
         except Exception:
             pass
         await cb.message.answer(
@@ -304,7 +680,7 @@ async def main():
             await msg.answer("Контекст потерялся. Нажми кнопку ещё раз.")
             return
 
-        changed = db.set_decision(
+        row = await adb.set_decision(
             req_id=req_id,
             status=status,
             admin_id=msg.from_user.id,
@@ -313,17 +689,26 @@ async def main():
         )
         await state.clear()
 
-        if changed != 1:
+        if row is None:
             await msg.answer("Не удалось зафиксировать решение (возможно, статус уже изменился).")
             return
 
-        try:
-            export_one()
-        except Exception as e:
-            await msg.answer(f"Решение сохранено, но экспорт упал: {e}")
-            return
+        await refresh_admin_cards(fanout, req_id, row)
+        export_worker.enqueue(msg.chat.id, req_id)
+        await msg.answer(f"Готово. Заявка №{req_id} → {status}. Выгрузка в Google Sheets поставлена в очередь.")
 
-        await msg.answer(f"Готово. Заявка №{req_id} → {status} и выгружена в Google Sheets.")
+    @dp.callback_query(F.data.startswith("att:"))
+    async def attachment(cb: CallbackQuery):
+        if not is_admin(cb.from_user.id):
+            await cb.answer("Не админ.", show_alert=True)
+            return
+        req_id = int(cb.data.split(":")[1])
+        atts = await adb.get_attachments(req_id)
+        if not atts:
+            await cb.answer("Вложений нет.", show_alert=True)
+            return
+        await cb.answer()
+        await fanout.deliver(cb.from_user.id, attachments.send_steps(atts, f"Приложение к заявке №{req_id}"))
 
     # ---------- ADMIN EDIT / REWORK ----------
     @dp.callback_query(F.data.startswith("edit:"))
@@ -333,7 +718,7 @@ async def main():
             return
         req_id = int(cb.data.split(":")[1])
 
-        row = db.get_request(req_id)
+        row = await adb.get_request(req_id)
         if not row:
             await cb.answer("Заявка не найдена.", show_alert=True)
             return
@@ -375,15 +760,26 @@ async def main():
         else:
             await cb.message.answer("Не понял поле.")
 
-    async def _notify_user(bot: Bot, req_id: int, text: str):
-        row = db.get_request(req_id)
-        if not row:
-            return
+    async def _notify_user(bot: Bot, row, text: str):
         try:
             await bot.send_message(int(row["author_tg_id"]), text)
         except Exception:
             pass
 
+    async def _rework(answer_to: Message, state: FSMContext, req_id: int, fields=None, note=None, by=None):
+        # правка + rework + комментарий одной транзакцией; карточки обновляем по вернувшейся строке
+        row = await adb.rework_request(
+            req_id, fields, note,
+            author_id=by.id if by else None,
+            author_name=(by.full_name or "Админ") if by else None,
+        )
+        if row is None:
+            await state.clear()
+            await answer_to.answer(f"Заявка №{req_id} уже решена — правка не применена.")
+            return None
+        await refresh_admin_cards(fanout, req_id, row)
+        return row
+
     @dp.message(AdminEdit.edit_title)
     async def edit_title(msg: Message, state: FSMContext):
         if not is_admin(msg.from_user.id): return
@@ -393,9 +789,10 @@ async def main():
             return
         data = await state.get_data()
         req_id = int(data["req_id"])
-        db.update_request_fields(req_id, {"title": title})
-        db.set_status(req_id, "rework")
-        await _notify_user(bot, req_id, f"По заявке №{req_id} админ поправил назначение. Проверь, ок ли.")
+        row = await _rework(msg, state, req_id, {"title": title})
+        if row is None:
+            return
+        await _notify_user(bot, row, f"По заявке №{req_id} админ поправил назначение. Проверь, ок ли.")
         await msg.answer(f"Ок. Назначение обновлено. Заявка №{req_id} → rework.")
         await state.set_state(AdminEdit.choose_field)
         await msg.answer("Ещё что правим?", reply_markup=build_edit_menu(req_id))
@@ -414,9 +811,10 @@ async def main():
             return
         data = await state.get_data()
         req_id = int(data["req_id"])
-        db.update_request_fields(req_id, {"amount": amount})
-        db.set_status(req_id, "rework")
-        await _notify_user(bot, req_id, f"По заявке №{req_id} админ поправил сумму на {nice_amount(amount)}. Проверь.")
+        row = await _rework(msg, state, req_id, {"amount": amount})
+        if row is None:
+            return
+        await _notify_user(bot, row, f"По заявке №{req_id} админ поправил сумму на {nice_amount(amount)}. Проверь.")
         await msg.answer(f"Ок. Сумма обновлена. Заявка №{req_id} → rework.")
         await state.set_state(AdminEdit.choose_field)
         await msg.answer("Ещё что правим?", reply_markup=build_edit_menu(req_id))
@@ -432,9 +830,10 @@ async def main():
             return
         data = await state.get_data()
         req_id = int(data["req_id"])
-        db.update_request_fields(req_id, {"payment_type": pay})
-        db.set_status(req_id, "rework")
-        await _notify_user(bot, req_id, f"По заявке №{req_id} админ поменял тип оплаты на: {PAYMENT_LABELS[pay]}.")
+        row = await _rework(cb.message, state, req_id, {"payment_type": pay})
+        if row is None:
+            return
+        await _notify_user(bot, row, f"По заявке №{req_id} админ поменял тип оплаты на: {PAYMENT_LABELS[pay]}.")
         await cb.answer("Ок")
         await cb.message.answer(f"Ок. Оплата обновлена. Заявка №{req_id} → rework.")
         await state.set_state(AdminEdit.choose_field)
@@ -451,9 +850,10 @@ async def main():
             return
         data = await state.get_data()
         req_id = int(data["req_id"])
-        db.update_request_fields(req_id, {"budget_category": bud})
-        db.set_status(req_id, "rework")
-        await _notify_user(bot, req_id, f"По заявке №{req_id} админ поменял статью бюджета на: {BUDGET_LABELS[bud]}.")
+        row = await _rework(cb.message, state, req_id, {"budget_category": bud})
+        if row is None:
+            return
+        await _notify_user(bot, row, f"По заявке №{req_id} админ поменял статью бюджета на: {BUDGET_LABELS[bud]}.")
         await cb.answer("Ок")
         await cb.message.answer(f"Ок. Статья обновлена. Заявка №{req_id} → rework.")
         await state.set_state(AdminEdit.choose_field)
@@ -467,17 +867,44 @@ async def main():
             note = ""
         data = await state.get_data()
         req_id = int(data["req_id"])
-        db.set_status(req_id, "rework")
+        row = await _rework(msg, state, req_id, note=note, by=msg.from_user)
+        if row is None:
+            return
         if note:
-            db.add_comment(req_id, msg.from_user.id, msg.from_user.full_name or "Админ", note)
-            await _notify_user(bot, req_id, f"По заявке №{req_id} требуется доработка:\n{note}")
+            await _notify_user(bot, row, f"По заявке №{req_id} требуется доработка:\n{note}")
         else:
-            await _notify_user(bot, req_id, f"По заявке №{req_id} требуется доработка. Уточни детали у админа.")
+            await _notify_user(bot, row, f"По заявке №{req_id} требуется доработка. Уточни детали у админа.")
         await msg.answer(f"Ок. Пользователю отправлено. Заявка №{req_id} → rework.")
         await state.set_state(AdminEdit.choose_field)
         await msg.answer("Ещё что правим?", reply_markup=build_edit_menu(req_id))
 
-    await dp.start_polling(bot)
+async def main():
+    await adb.run(migrations.migrate)
+    bot = Bot(token=read_token())
+    storage = SQLiteStorage()
+    await storage.load()
+    dp = Dispatcher(storage=storage)
+    middleware.setup(dp, bot)
+    export_worker = ExportWorker(bot)
+    fanout = FanOut(bot)
+
+    digest_worker = DigestWorker(lambda aid, rows, total: send_digest(fanout, aid, rows, total))
+
+    register_handlers(dp, bot, fanout, export_worker)
+
+    export_worker.start()
+    digest_worker.start()
+    try:
+        if webhook.enabled():
+            await webhook.run(bot, dp)
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        await digest_worker.stop()
+        await export_worker.stop()
+        await storage.close()
+        await adb.shutdown()
 
 if __name__ == "__main__":
     asyncio.run(main())
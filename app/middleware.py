@@ -0,0 +1,176 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import AnswerCallbackQuery, Response
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+log = logging.getLogger(__name__)
+
+# Флуд-контроль: у каждого пользователя ведро на USER_BURST апдейтов, пополняется USER_RATE в секунду.
+USER_RATE = float(os.environ.get("PAYBOT_USER_RATE", "1"))
+USER_BURST = float(os.environ.get("PAYBOT_USER_BURST", "8"))
+# повтор той же кнопки на том же сообщении в этом окне — двойной тап, второй отбрасываем
+DEDUP_WINDOW = 3.0
+# если хендлер не ответил на callback за это время, отвечаем пустым — спиннер в клиенте гаснет
+EARLY_ANSWER_S = 0.3
+MAX_TRACKED = 10000
+# альбом приходит пачкой апдейтов с одним media_group_id; в Telegram в альбоме до 10 файлов
+ALBUM_MAX = 10
+
+Handler = Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]
+
+class Bucket:
+    __slots__ = ("tokens", "updated", "warned", "album", "album_parts")
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.updated = now
+        self.warned = False
+        self.album = None
+        self.album_parts = 0
+
+    def take(self, rate: float, capacity: float, now: float) -> bool:
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.warned = False
+            return True
+        return False
+
+def _trim(d: OrderedDict, limit: int = MAX_TRACKED):
+    while len(d) > limit:
+        d.popitem(last=False)
+
+class Throttle(BaseMiddleware):
+    def __init__(self, rate: float = USER_RATE, burst: float = USER_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: "OrderedDict[int, Bucket]" = OrderedDict()
+        self.dropped = 0
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]):
+        user = getattr(event, "from_user", None)
+        if user is None:
+            return await handler(event, data)
+        now = time.monotonic()
+        b = self._buckets.get(user.id)
+        if b is None:
+            b = self._buckets[user.id] = Bucket(self.burst, now)
+            _trim(self._buckets)
+        self._buckets.move_to_end(user.id)
+        # весь альбом стоит один токен: части после первой пропускаем без списания
+        album = getattr(event, "media_group_id", None)
+        if album and album == b.album and b.album_parts < ALBUM_MAX:
+            b.album_parts += 1
+            return await handler(event, data)
+        if b.take(self.rate, self.burst, now):
+            b.album, b.album_parts = album, 1 if album else 0
+            return await handler(event, data)
+
+        # лишнее молча выкидываем, предупреждаем один раз до следующего пропущенного апдейта
+        log.info("throttled user %s", user.id)
+        self.dropped += 1
+        if isinstance(event, CallbackQuery):
+            await event.answer("Слишком часто, подожди пару секунд.")
+        elif not b.warned:
+            await event.answer("Слишком часто, подожди пару секунд.")
+        b.warned = True
+        return None
+
+class CallbackDedup(BaseMiddleware):
+    def __init__(self, window: float = DEDUP_WINDOW):
+        self.window = window
+        self._seen: "OrderedDict[tuple, float]" = OrderedDict()
+
+    async def __call__(self, handler: Handler, event: CallbackQuery, data: Dict[str, Any]):
+        msg = event.message
+        key = (event.from_user.id, msg.chat.id if msg else None, msg.message_id if msg else event.inline_message_id, event.data)
+        now = time.monotonic()
+        seen = self._seen.get(key)
+        if seen is not None and now - seen < self.window:
+            await event.answer("Уже обрабатываю…")
+            return None
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        _trim(self._seen)
+        return await handler(event, data)
+
+class AnswerOnce(BaseRequestMiddleware):
+    # Сессионный middleware: второй answerCallbackQuery на тот же callback не уходит в Telegram
+    # (он бы всё равно вернул ошибку). Так хендлеры могут отвечать сами, а EarlyAnswer — подстраховывать.
+    # Если первым ушёл пустой ранний ответ, а хендлер хотел показать алерт (show_alert), текст
+    # приходит пользователю обычным сообщением, а не теряется. Опоздавшие тосты («Ок») просто отбрасываем.
+    def __init__(self):
+        # callback_id -> кому досылать текст, пока первый ответ был пустым; None — досылать не нужно
+        self._answered: "OrderedDict[str, Optional[int]]" = OrderedDict()
+        self._users: "OrderedDict[str, int]" = OrderedDict()
+
+    def answered(self, callback_id: str) -> bool:
+        return callback_id in self._answered
+
+    def track(self, callback_id: str, user_id: int):
+        self._users[callback_id] = user_id
+        _trim(self._users)
+
+    async def __call__(self, make_request, bot: Bot, method):
+        if not isinstance(method, AnswerCallbackQuery):
+            return await make_request(bot, method)
+        cid = method.callback_query_id
+        if cid in self._answered:
+            user_id = self._answered[cid]
+            if method.text and method.show_alert and user_id is not None:
+                self._answered[cid] = None
+                try:
+                    await bot.send_message(user_id, method.text)
+                except Exception as e:
+                    log.debug("late callback text to %s failed: %s", user_id, e)
+            return Response(ok=True, result=True)
+        user_id = self._users.pop(cid, None)
+        self._answered[cid] = None if method.text else user_id
+        _trim(self._answered)
+        return await make_request(bot, method)
+
+class EarlyAnswer(BaseMiddleware):
+    def __init__(self, answers: AnswerOnce, delay: float = EARLY_ANSWER_S):
+        self.answers = answers
+        self.delay = delay
+
+    async def _answer_later(self, event: CallbackQuery):
+        await asyncio.sleep(self.delay)
+        await self._answer(event)
+
+    async def _answer(self, event: CallbackQuery):
+        if self.answers.answered(event.id):
+            return
+        try:
+            await event.answer()
+        except Exception as e:
+            log.debug("early answer %s failed: %s", event.id, e)
+
+    async def __call__(self, handler: Handler, event: CallbackQuery, data: Dict[str, Any]):
+        self.answers.track(event.id, event.from_user.id)
+        timer = asyncio.create_task(self._answer_later(event))
+        try:
+            return await handler(event, data)
+        finally:
+            timer.cancel()
+            # хендлер не нашёлся или не ответил — всё равно гасим спиннер
+            await self._answer(event)
+
+def setup(dp: Dispatcher, bot: Bot, rate: Optional[float] = None, burst: Optional[float] = None):
+    # Порядок для callback: раньше всего ответ-страховка, потом флуд-контроль, потом дедупликация.
+    answers = AnswerOnce()
+    bot.session.middleware(answers)
+    throttle = Throttle(USER_RATE if rate is None else rate, USER_BURST if burst is None else burst)
+    dp.callback_query.outer_middleware(EarlyAnswer(answers))
+    dp.message.outer_middleware(throttle)
+    dp.callback_query.outer_middleware(throttle)
+    dp.callback_query.outer_middleware(CallbackDedup())
+    return throttle
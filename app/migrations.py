@@ -0,0 +1,310 @@
+import sqlite3
+
+from . import db
+
+# Версия схемы хранится в PRAGMA user_version. Миграции только добавляются в конец.
+MIGRATIONS = [
+    (1, """
+        CREATE TABLE IF NOT EXISTS requests(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          created_at TEXT NOT NULL DEFAULT (datetime('now')),
+          author_tg_id INTEGER NOT NULL,
+          author_name TEXT,
+          title TEXT NOT NULL,
+          amount REAL NOT NULL,
+          status TEXT NOT NULL DEFAULT 'new',
+          decision_at TEXT,
+          decision_by_tg_id INTEGER,
+          decision_by_name TEXT,
+          decision_comment TEXT,
+          exported_to_sheets INTEGER NOT NULL DEFAULT 0,
+          attachment_file_id TEXT,
+          attachment_kind TEXT,
+          payment_type TEXT,
+          budget_category TEXT
+        );
+        CREATE TABLE IF NOT EXISTS comments(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          request_id INTEGER NOT NULL REFERENCES requests(id),
+          created_at TEXT NOT NULL DEFAULT (datetime('now')),
+          author_tg_id INTEGER,
+          author_name TEXT,
+          text TEXT
+        );
+    """),
+    (2, """
+        CREATE TABLE IF NOT EXISTS sheet_totals(
+          sheet_title TEXT PRIMARY KEY,
+          totals_row INTEGER NOT NULL,
+          planned_row INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS sheet_rows(
+          request_id INTEGER PRIMARY KEY,
+          sheet_title TEXT NOT NULL,
+          row_number INTEGER NOT NULL,
+          content_hash TEXT NOT NULL,
+          confirmed INTEGER NOT NULL DEFAULT 0
+        );
+    """),
+    (3, """
+        CREATE INDEX IF NOT EXISTS idx_requests_export_pending
+          ON requests(decision_at)
+          WHERE status IN ('approved','rejected') AND exported_to_sheets = 0;
+        CREATE INDEX IF NOT EXISTS idx_requests_status_decision
+          ON requests(status, decision_at);
+        CREATE INDEX IF NOT EXISTS idx_comments_request
+          ON comments(request_id, id);
+        ANALYZE;
+    """),
+    (4, """
+        CREATE TABLE IF NOT EXISTS month_totals(
+          month TEXT NOT NULL,
+          status TEXT NOT NULL,
+          budget_category TEXT NOT NULL,
+          payment_type TEXT NOT NULL,
+          cnt INTEGER NOT NULL DEFAULT 0,
+          total REAL NOT NULL DEFAULT 0,
+          PRIMARY KEY (month, status, budget_category, payment_type)
+        );
+        DELETE FROM month_totals;
+        INSERT INTO month_totals(month, status, budget_category, payment_type, cnt, total)
+          SELECT substr(decision_at, 1, 7), status, COALESCE(budget_category, ''), COALESCE(payment_type, ''),
+                 COUNT(*), COALESCE(SUM(amount), 0)
+          FROM requests
+          WHERE status IN ('approved','rejected') AND decision_at IS NOT NULL
+          GROUP BY 1, 2, 3, 4;
+
+        -- Агрегаты ведутся триггерами, т.е. в той же транзакции, что и set_decision/set_status/правка полей.
+        CREATE TRIGGER IF NOT EXISTS trg_month_totals_ins AFTER INSERT ON requests
+        WHEN NEW.status IN ('approved','rejected') AND NEW.decision_at IS NOT NULL
+        BEGIN
+          INSERT INTO month_totals(month, status, budget_category, payment_type, cnt, total)
+          VALUES (substr(NEW.decision_at, 1, 7), NEW.status, COALESCE(NEW.budget_category, ''),
+                  COALESCE(NEW.payment_type, ''), 1, NEW.amount)
+          ON CONFLICT(month, status, budget_category, payment_type)
+          DO UPDATE SET cnt = cnt + 1, total = total + excluded.total;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_month_totals_upd
+        AFTER UPDATE OF status, decision_at, amount, budget_category, payment_type ON requests
+        BEGIN
+          UPDATE month_totals SET cnt = cnt - 1, total = total - OLD.amount
+          WHERE OLD.status IN ('approved','rejected') AND OLD.decision_at IS NOT NULL
+            AND month = substr(OLD.decision_at, 1, 7) AND status = OLD.status
+            AND budget_category = COALESCE(OLD.budget_category, '')
+            AND payment_type = COALESCE(OLD.payment_type, '');
+          INSERT INTO month_totals(month, status, budget_category, payment_type, cnt, total)
+          SELECT substr(NEW.decision_at, 1, 7), NEW.status, COALESCE(NEW.budget_category, ''),
+                 COALESCE(NEW.payment_type, ''), 1, NEW.amount
+          WHERE NEW.status IN ('approved','rejected') AND NEW.decision_at IS NOT NULL
+          ON CONFLICT(month, status, budget_category, payment_type)
+          DO UPDATE SET cnt = cnt + 1, total = total + excluded.total;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_month_totals_del AFTER DELETE ON requests
+        WHEN OLD.status IN ('approved','rejected') AND OLD.decision_at IS NOT NULL
+        BEGIN
+          UPDATE month_totals SET cnt = cnt - 1, total = total - OLD.amount
+          WHERE month = substr(OLD.decision_at, 1, 7) AND status = OLD.status
+            AND budget_category = COALESCE(OLD.budget_category, '')
+            AND payment_type = COALESCE(OLD.payment_type, '');
+        END;
+    """),
+    (5, """
+        CREATE TABLE IF NOT EXISTS admin_cards(
+          request_id INTEGER NOT NULL REFERENCES requests(id),
+          admin_chat_id INTEGER NOT NULL,
+          message_id INTEGER NOT NULL,
+          PRIMARY KEY (request_id, admin_chat_id)
+        );
+    """),
+    (6, """
+        CREATE TABLE IF NOT EXISTS fsm_states(
+          key TEXT PRIMARY KEY,
+          state TEXT,
+          data TEXT NOT NULL DEFAULT '{}',
+          updated_at TEXT NOT NULL DEFAULT (datetime('now'))
+        );
+    """),
+    (7, """
+        -- Журнал изменений заявок: append-only, seq монотонный. Пишется триггерами,
+        -- т.е. в той же транзакции, что и сама правка. Потребители хранят свой seq в consumer_offsets.
+        CREATE TABLE IF NOT EXISTS request_changes(
+          seq INTEGER PRIMARY KEY AUTOINCREMENT,
+          request_id INTEGER NOT NULL,
+          op TEXT NOT NULL,
+          old_status TEXT,
+          new_status TEXT,
+          fields TEXT NOT NULL DEFAULT '',
+          changed_at TEXT NOT NULL DEFAULT (datetime('now'))
+        );
+        CREATE INDEX IF NOT EXISTS idx_request_changes_request ON request_changes(request_id, seq);
+        CREATE TABLE IF NOT EXISTS consumer_offsets(
+          consumer TEXT PRIMARY KEY,
+          seq INTEGER NOT NULL DEFAULT 0,
+          updated_at TEXT NOT NULL DEFAULT (datetime('now'))
+        );
+
+        CREATE TRIGGER IF NOT EXISTS trg_request_changes_ins AFTER INSERT ON requests
+        BEGIN
+          INSERT INTO request_changes(request_id, op, new_status, fields)
+          VALUES (NEW.id, 'create', NEW.status, '');
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_request_changes_upd AFTER UPDATE ON requests
+        WHEN OLD.status IS NOT NEW.status OR OLD.title IS NOT NEW.title OR OLD.amount IS NOT NEW.amount
+          OR OLD.payment_type IS NOT NEW.payment_type OR OLD.budget_category IS NOT NEW.budget_category
+          OR OLD.decision_at IS NOT NEW.decision_at OR OLD.decision_by_tg_id IS NOT NEW.decision_by_tg_id
+          OR OLD.decision_comment IS NOT NEW.decision_comment
+          OR OLD.attachment_file_id IS NOT NEW.attachment_file_id
+        BEGIN
+          INSERT INTO request_changes(request_id, op, old_status, new_status, fields)
+          VALUES (NEW.id, 'update', OLD.status, NEW.status, rtrim(
+            CASE WHEN OLD.status IS NOT NEW.status THEN 'status,' ELSE '' END ||
+            CASE WHEN OLD.title IS NOT NEW.title THEN 'title,' ELSE '' END ||
+            CASE WHEN OLD.amount IS NOT NEW.amount THEN 'amount,' ELSE '' END ||
+            CASE WHEN OLD.payment_type IS NOT NEW.payment_type THEN 'payment_type,' ELSE '' END ||
+            CASE WHEN OLD.budget_category IS NOT NEW.budget_category THEN 'budget_category,' ELSE '' END ||
+            CASE WHEN OLD.decision_at IS NOT NEW.decision_at
+                   OR OLD.decision_by_tg_id IS NOT NEW.decision_by_tg_id
+                   OR OLD.decision_comment IS NOT NEW.decision_comment THEN 'decision,' ELSE '' END ||
+            CASE WHEN OLD.attachment_file_id IS NOT NEW.attachment_file_id THEN 'attachment,' ELSE '' END,
+          ','));
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_request_changes_comment AFTER INSERT ON comments
+        BEGIN
+          INSERT INTO request_changes(request_id, op, fields) VALUES (NEW.request_id, 'comment', 'comment');
+        END;
+
+        -- всё, что ещё не выгружено, попадает в журнал, чтобы экспорт подхватил это с seq 0
+        INSERT INTO request_changes(request_id, op, new_status, fields)
+          SELECT id, 'snapshot', status, '' FROM requests
+          WHERE status IN ('approved','rejected') AND exported_to_sheets = 0
+          ORDER BY decision_at;
+        INSERT OR IGNORE INTO consumer_offsets(consumer, seq) VALUES ('sheets', 0);
+    """),
+    (8, """
+        -- Полнотекстовый поиск для /find: строка на заявку (rowid = requests.id),
+        -- комментарии склеены в одну колонку. Синхронизируется триггерами.
+        CREATE VIRTUAL TABLE IF NOT EXISTS requests_fts USING fts5(
+          title, author_name, comments,
+          tokenize = "unicode61 remove_diacritics 2"
+        );
+        DELETE FROM requests_fts;
+        INSERT INTO requests_fts(rowid, title, author_name, comments)
+          SELECT r.id, r.title, r.author_name,
+                 COALESCE((SELECT group_concat(text, ' ') FROM comments WHERE request_id = r.id), '')
+          FROM requests r;
+
+        CREATE TRIGGER IF NOT EXISTS trg_requests_fts_ins AFTER INSERT ON requests
+        BEGIN
+          INSERT INTO requests_fts(rowid, title, author_name, comments) VALUES (NEW.id, NEW.title, NEW.author_name, '');
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_requests_fts_upd AFTER UPDATE OF title, author_name ON requests
+        BEGIN
+          UPDATE requests_fts SET title = NEW.title, author_name = NEW.author_name WHERE rowid = NEW.id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_requests_fts_del AFTER DELETE ON requests
+        BEGIN
+          DELETE FROM requests_fts WHERE rowid = OLD.id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_requests_fts_comment AFTER INSERT ON comments
+        BEGIN
+          UPDATE requests_fts SET comments = CASE WHEN comments = '' THEN NEW.text ELSE comments || ' ' || NEW.text END
+          WHERE rowid = NEW.request_id;
+        END;
+    """),
+    (9, """
+        -- очередь /pending: keyset по id среди нерешённых
+        CREATE INDEX IF NOT EXISTS idx_requests_open ON requests(id) WHERE status IN ('new','rework');
+        ANALYZE;
+    """),
+    (10, """
+        -- Режим уведомлений админа: instant — карточка сразу, digest — сводка раз в digest_minutes.
+        CREATE TABLE IF NOT EXISTS admin_settings(
+          admin_chat_id INTEGER PRIMARY KEY,
+          notify_mode TEXT NOT NULL DEFAULT 'instant',
+          digest_minutes INTEGER NOT NULL DEFAULT 15,
+          updated_at TEXT NOT NULL DEFAULT (datetime('now'))
+        );
+        -- очередь сводки: переживает рестарт, строки удаляются только после доставки
+        CREATE TABLE IF NOT EXISTS digest_queue(
+          seq INTEGER PRIMARY KEY AUTOINCREMENT,
+          admin_chat_id INTEGER NOT NULL,
+          request_id INTEGER NOT NULL,
+          queued_at TEXT NOT NULL DEFAULT (datetime('now')),
+          UNIQUE(admin_chat_id, request_id)
+        );
+    """),
+    (11, """
+        -- Несколько файлов на заявку. file_id — проверенный для этого бота (из входящего сообщения
+        -- или ответа на отправку); sha256/local_path заполняются, если включён локальный архив.
+        CREATE TABLE IF NOT EXISTS request_attachments(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          request_id INTEGER NOT NULL,
+          kind TEXT NOT NULL,
+          file_id TEXT NOT NULL,
+          file_unique_id TEXT,
+          sha256 TEXT,
+          local_path TEXT,
+          created_at TEXT NOT NULL DEFAULT (datetime('now')),
+          FOREIGN KEY(request_id) REFERENCES requests(id) ON DELETE CASCADE
+        );
+        CREATE INDEX IF NOT EXISTS idx_request_attachments_request ON request_attachments(request_id, id);
+        CREATE INDEX IF NOT EXISTS idx_request_attachments_sha ON request_attachments(sha256) WHERE sha256 IS NOT NULL;
+        INSERT INTO request_attachments(request_id, kind, file_id)
+          SELECT id, COALESCE(NULLIF(attachment_kind, ''), 'document'), attachment_file_id
+          FROM requests
+          WHERE attachment_file_id IS NOT NULL AND attachment_file_id != ''
+            AND id NOT IN (SELECT request_id FROM request_attachments);
+    """),
+    (12, """
+        -- сообщения-сводки тоже держат кнопки заявки: kind='digest', одно сообщение на несколько заявок
+        ALTER TABLE admin_cards ADD COLUMN kind TEXT NOT NULL DEFAULT 'card';
+        CREATE INDEX IF NOT EXISTS idx_admin_cards_message ON admin_cards(admin_chat_id, message_id);
+    """),
+]
+
+def current_version(c) -> int:
+    return int(c.execute("PRAGMA user_version").fetchone()[0])
+
+def _statements(sql: str):
+    # executescript сам коммитит открытую транзакцию, поэтому режем скрипт на операторы
+    # (триггеры с ; внутри BEGIN…END собираются целиком через complete_statement)
+    buf = ""
+    for part in sql.split(";"):
+        buf += part + ";"
+        if sqlite3.complete_statement(buf):
+            if buf.strip(" \n;"):
+                yield buf
+            buf = ""
+
+def migrate(c=None) -> int:
+    c = c or db.conn()
+    version = current_version(c)
+    for target, sql in MIGRATIONS:
+        if target <= version:
+            continue
+        # BEGIN IMMEDIATE берёт блокировку записи сразу; версию перечитываем уже под ней —
+        # бот и export_one/sheets_totals/aggregates могут стартовать одновременно
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            version = current_version(c)
+            if target > version:
+                for stmt in _statements(sql):
+                    c.execute(stmt)
+                c.execute(f"PRAGMA user_version = {target}")
+                version = target
+            c.commit()
+        except Exception:
+            if c.in_transaction:
+                c.rollback()
+            raise
+    return version
+
+if __name__ == "__main__":
+    print(f"schema_version:{migrate()}")
@@ -0,0 +1,46 @@
+import os
+import csv
+import tempfile
+
+from . import export_one
+
+# Выгрузка месяца файлом: строки идут из курсора SQLite прямо в писатель, в памяти
+# держится одна строка. Вызывать из потока (asyncio.to_thread), не из event loop.
+FORMATS = ("csv", "xlsx")
+
+def write_csv(path: str, rows) -> int:
+    n = 0
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        w = csv.writer(f, delimiter=";")
+        w.writerow(export_one.HEADER)
+        for row in rows:
+            w.writerow(export_one.sheet_row(row))
+            n += 1
+    return n
+
+def write_xlsx(path: str, rows, title: str) -> int:
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+    ws.append(export_one.HEADER)
+    n = 0
+    for row in rows:
+        ws.append(export_one.sheet_row(row))
+        n += 1
+    wb.save(path)
+    return n
+
+def write_month_file(year: str, month2: str, fmt: str = "csv"):
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format: {fmt}")
+    title = f"{int(month2):02d}.{int(year)}"
+    fd, path = tempfile.mkstemp(prefix=f"paybot-{year}-{month2}-", suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        rows = export_one.month_rows(year, month2)
+        n = write_xlsx(path, rows, title) if fmt == "xlsx" else write_csv(path, rows)
+    except Exception:
+        os.unlink(path)
+        raise
+    return path, n
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError
+
+log = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений/с на бота и ~1/с в один чат (с небольшим всплеском).
+GLOBAL_RATE = 25.0
+CHAT_RATE = 1.0
+CHAT_BURST = 3
+RETRIES = 3
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if self.updated is not None:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+@dataclass
+class Delivery:
+    chat_id: int
+    ok: bool
+    sent: int = 0
+    error: Optional[str] = None
+    results: list = field(default_factory=list)
+
+Step = Callable[[Bot, int], Awaitable]
+
+class FanOut:
+    def __init__(self, bot: Bot, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 chat_burst: int = CHAT_BURST, retries: int = RETRIES):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self._chats: Dict[int, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            b = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return b
+
+    async def call(self, chat_id: int, step: Step):
+        for attempt in range(self.retries + 1):
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await step(self.bot, chat_id)
+            except TelegramRetryAfter as e:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(e.retry_after)
+            except TelegramNetworkError:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+
+    async def deliver(self, chat_id: int, steps: List[Step]) -> Delivery:
+        # шаги одному получателю идут по порядку (карточка, потом вложение)
+        d = Delivery(chat_id=chat_id, ok=True)
+        for step in steps:
+            try:
+                d.results.append(await self.call(chat_id, step))
+            except Exception as e:
+                d.ok = False
+                d.error = f"{type(e).__name__}: {e}"
+                log.warning("delivery to %s failed after %d steps: %s", chat_id, d.sent, d.error)
+                break
+            d.sent += 1
+        return d
+
+    async def broadcast(self, chat_ids: Iterable[int], steps: List[Step]) -> List[Delivery]:
+        return list(await asyncio.gather(*(self.deliver(cid, steps) for cid in chat_ids)))
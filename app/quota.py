@@ -0,0 +1,90 @@
+import os
+import time
+import random
+import logging
+import threading
+from collections import Counter
+
+log = logging.getLogger(__name__)
+
+# Квоты Sheets API по умолчанию — 60 чтений и 60 записей в минуту на пользователя.
+READS_PER_MIN = float(os.environ.get("SHEETS_READS_PER_MIN", "60"))
+WRITES_PER_MIN = float(os.environ.get("SHEETS_WRITES_PER_MIN", "60"))
+BURST = 10
+RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 64.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    def __init__(self, per_min: float, capacity: float):
+        self.rate = per_min / 60.0
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        # блокирует поток экспорта до появления токена; возвращает, сколько ждали
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+def status_of(e: Exception):
+    response = getattr(e, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is None:
+        status = getattr(e, "code", None)
+    return status if isinstance(status, int) else None
+
+class QuotaGovernor:
+    def __init__(self, reads_per_min: float = READS_PER_MIN, writes_per_min: float = WRITES_PER_MIN,
+                 burst: float = BURST, retries: int = RETRIES):
+        self.buckets = {
+            "read": TokenBucket(reads_per_min, burst),
+            "write": TokenBucket(writes_per_min, burst),
+        }
+        self.retries = retries
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def _count(self, key: str, n=1):
+        with self._lock:
+            self.counts[key] += n
+
+    def snapshot(self) -> Counter:
+        with self._lock:
+            return Counter(self.counts)
+
+    def spent_since(self, before: Counter) -> dict:
+        now = self.snapshot()
+        now.subtract(before)
+        return {k: v for k, v in now.items() if v}
+
+    def call(self, kind: str, fn, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            waited = self.buckets[kind].acquire()
+            if waited:
+                self._count("throttled_s", round(waited, 3))
+            self._count(kind)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                status = status_of(e)
+                if status not in RETRY_STATUSES or attempt == self.retries:
+                    raise
+                delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+                self._count("retries")
+                log.warning("sheets %s got %s, retry %d in %.1fs", kind, status, attempt + 1, delay)
+                time.sleep(delay)
+
+GOVERNOR = QuotaGovernor()
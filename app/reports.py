@@ -0,0 +1,152 @@
+import time
+import datetime as dt
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from . import db
+from .export_one import PAYMENT_LABELS, BUDGET_LABELS
+
+# /report: суммы по статье/типу оплаты за произвольный период. Целые месяцы берутся из
+# month_totals, неполные края — из requests по индексу (status, decision_at).
+GROUPS = {
+    "budget": ("budget_category",),
+    "pay": ("payment_type",),
+    "both": ("budget_category", "payment_type"),
+}
+CACHE_SIZE = 64
+# страховка от записей мимо бота (aggregates --fix, ручные правки базы)
+CACHE_TTL = 600.0
+
+# (start, end, group) -> (rendered_at, text); start/end — даты "YYYY-MM-DD", end не включительно
+_cache: "OrderedDict[Tuple[str, str, str], Tuple[float, str]]" = OrderedDict()
+
+def parse_period(args) -> Tuple[str, str]:
+    # ГГГГ-ММ или ГГГГ-ММ-ДД; вторая граница включительно, по умолчанию — текущий месяц
+    def bound(s: str, upper: bool) -> dt.date:
+        parts = [int(x) for x in s.split("-")]
+        if len(parts) == 3:
+            d = dt.date(*parts)
+            return d + dt.timedelta(days=1) if upper else d
+        if len(parts) != 2:
+            raise ValueError(s)
+        d = dt.date(parts[0], parts[1], 1)
+        return _next_month(d) if upper else d
+
+    if not args:
+        # decision_at в базе — UTC (datetime('now'))
+        first = dt.datetime.now(dt.timezone.utc).date().replace(day=1)
+        return first.isoformat(), _next_month(first).isoformat()
+    start = bound(args[0], False)
+    end = bound(args[1] if len(args) > 1 else args[0], True)
+    if end <= start:
+        raise ValueError("empty period")
+    return start.isoformat(), end.isoformat()
+
+def _next_month(d: dt.date) -> dt.date:
+    return dt.date(d.year + 1, 1, 1) if d.month == 12 else dt.date(d.year, d.month + 1, 1)
+
+def _split(start: str, end: str):
+    # [start, end) -> края по дням и целые месяцы между ними
+    s, e = dt.date.fromisoformat(start), dt.date.fromisoformat(end)
+    first_full = s if s.day == 1 else _next_month(s)
+    last_full = e.replace(day=1)
+    if first_full >= last_full:
+        return [(start, end)], None
+    edges = []
+    if s < first_full:
+        edges.append((start, first_full.isoformat()))
+    if last_full < e:
+        edges.append((last_full.isoformat(), end))
+    return edges, (first_full.strftime("%Y-%m"), last_full.strftime("%Y-%m"))
+
+def totals(start: str, end: str, group: str) -> Dict[tuple, list]:
+    cols = GROUPS[group]
+    keys = ", ".join(cols)
+    edges, months = _split(start, end)
+    out: Dict[tuple, list] = {}
+
+    def add(rows):
+        for r in rows:
+            acc = out.setdefault((r["status"],) + tuple(r[k] for k in cols), [0, 0.0])
+            acc[0] += int(r["cnt"])
+            acc[1] += float(r["total"])
+
+    with db.conn() as c:
+        if months:
+            add(c.execute(f"""
+                SELECT status, {keys}, SUM(cnt) AS cnt, SUM(total) AS total
+                FROM month_totals
+                WHERE month >= ? AND month < ?
+                GROUP BY status, {keys}
+            """, months))
+        for lo, hi in edges:
+            add(c.execute(f"""
+                SELECT status, {", ".join(f"COALESCE({k}, '') AS {k}" for k in cols)},
+                       COUNT(*) AS cnt, COALESCE(SUM(amount), 0) AS total
+                FROM requests
+                WHERE status IN ('approved','rejected') AND decision_at >= ? AND decision_at < ?
+                GROUP BY 1, {", ".join(str(i + 2) for i in range(len(cols)))}
+            """, (lo, hi)))
+    return {k: v for k, v in out.items() if v[0]}
+
+def _label(col: str, value: str) -> str:
+    labels = BUDGET_LABELS if col == "budget_category" else PAYMENT_LABELS
+    return labels.get(value, value or "—")
+
+def _money(x: float) -> str:
+    return f"{x:,.2f}".replace(",", " ")
+
+def render(start: str, end: str, group: str, data: Dict[tuple, list]) -> str:
+    cols = GROUPS[group]
+    last = (dt.date.fromisoformat(end) - dt.timedelta(days=1)).isoformat()
+    lines = [f"Отчёт {start} — {last}"]
+    if not data:
+        lines.append("Решённых заявок за период нет.")
+        return "\n".join(lines)
+    for status, title in (("approved", "Согласовано"), ("rejected", "Отклонено")):
+        part = sorted(((k[1:], v) for k, v in data.items() if k[0] == status), key=lambda kv: -kv[1][1])
+        if not part:
+            continue
+        cnt = sum(v[0] for _, v in part)
+        total = sum(v[1] for _, v in part)
+        lines.append("")
+        lines.append(f"{title}: {cnt} шт., {_money(total)}")
+        for key, (n, s) in part:
+            name = " / ".join(_label(col, v) for col, v in zip(cols, key))
+            lines.append(f"• {name}: {n} шт., {_money(s)}")
+    return "\n".join(lines)
+
+# Кэш трогается только из event loop: промах считается в потоке БД (adb.run(totals, ...)),
+# а результат кладётся через store с поколением, взятым до запроса, — если между ними
+# пришла инвалидация, устаревший текст не сохраняется.
+_generation = 0
+
+def generation() -> int:
+    return _generation
+
+def cached(start: str, end: str, group: str) -> Optional[str]:
+    key = (start, end, group)
+    hit = _cache.get(key)
+    if hit is None or time.monotonic() - hit[0] >= CACHE_TTL:
+        return None
+    _cache.move_to_end(key)
+    return hit[1]
+
+def store(start: str, end: str, group: str, text: str, gen: int):
+    if gen != _generation:
+        return
+    _cache[(start, end, group)] = (time.monotonic(), text)
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+def invalidate(decision_at: Optional[str] = None):
+    # decision_at — "YYYY-MM-DD ..." затронутой заявки; выкидываем отчёты, чей период её содержит.
+    # None — всё.
+    global _generation
+    _generation += 1
+    if decision_at is None:
+        _cache.clear()
+        return
+    day = decision_at[:10]
+    for key in [k for k in _cache if k[0] <= day < k[1]]:
+        del _cache[key]
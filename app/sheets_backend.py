@@ -0,0 +1,208 @@
+import os
+import re
+from collections import Counter
+from typing import Dict, List, NamedTuple, Protocol, Sequence, Tuple
+
+from .quota import GOVERNOR, QuotaGovernor
+
+SA = os.environ.get("GOOGLE_SA", "/opt/services/paybot/secrets/google_sa.json").strip()
+SPREADSHEET_ID = os.environ.get("GSHEET_ID", "").strip()
+NEW_SHEET_ROWS = 2000
+NEW_SHEET_COLS = 20
+GROW_ROWS = 100
+
+class Block(NamedTuple):
+    start_row: int
+    rows: Sequence[Sequence]
+    bold: bool = False
+
+# Всё, что экспорту нужно от таблицы. Листы адресуются по названию (MM.YYYY), строки с 1.
+# open_month_sheet создаёт лист с шапкой, если его нет, и тогда возвращает True;
+# write пишет значения и жирность всех блоков одним вызовом, сетка растёт сама.
+class SheetsBackend(Protocol):
+    def open_month_sheet(self, title: str, header: Sequence[str]) -> bool:
+        ...
+
+    def read_range(self, title: str, a1: str) -> List[List[str]]:
+        ...
+
+    def write(self, title: str, blocks: Sequence[Block]) -> None:
+        ...
+
+    def delete_rows(self, title: str, start: int, end: int) -> None:
+        ...
+
+_A1 = re.compile(r"^([A-Z]+)?(\d+)?(?::([A-Z]+)?(\d+)?)?$")
+
+def _col(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - ord("A") + 1
+    return n
+
+def parse_a1(a1: str) -> Tuple[int, int, int, int]:
+    # (row1, col1, row2, col2), открытые границы — 0
+    m = _A1.match(a1.strip().upper())
+    if not m:
+        raise ValueError(f"bad range: {a1}")
+    c1, r1, c2, r2 = m.groups()
+    col1, row1 = _col(c1) if c1 else 0, int(r1) if r1 else 0
+    if ":" not in a1:
+        return row1, col1, row1, col1
+    return row1, col1, int(r2) if r2 else 0, _col(c2) if c2 else 0
+
+def _cell(v, bold: bool):
+    if isinstance(v, (int, float)):
+        value = {"numberValue": v}
+    else:
+        value = {"stringValue": "" if v is None else str(v)}
+    return {"userEnteredValue": value, "userEnteredFormat": {"textFormat": {"bold": bold}}}
+
+# Каждый реальный вызов API идёт через QuotaGovernor: токены на чтение/запись и ретраи на 429/5xx.
+class GspreadBackend:
+    def __init__(self, spreadsheet, governor: QuotaGovernor = GOVERNOR):
+        self.sh = spreadsheet
+        self.governor = governor
+        self._sheets: Dict[str, object] = {}
+        self._rows: Dict[str, int] = {}
+
+    @classmethod
+    def from_service_account(cls, sa_path: str = SA, spreadsheet_id: str = SPREADSHEET_ID,
+                             governor: QuotaGovernor = GOVERNOR):
+        import gspread
+        from google.oauth2.service_account import Credentials
+
+        if not spreadsheet_id:
+            raise RuntimeError("GSHEET_ID is empty")
+        creds = Credentials.from_service_account_file(
+            sa_path,
+            scopes=["https://www.googleapis.com/auth/spreadsheets"],
+        )
+        gc = gspread.authorize(creds)
+        return cls(governor.call("read", gc.open_by_key, spreadsheet_id), governor)
+
+    def _ws(self, title: str):
+        ws = self._sheets.get(title)
+        if ws is None:
+            ws = self._sheets[title] = self.governor.call("read", self.sh.worksheet, title)
+            self._rows[title] = ws.row_count
+        return ws
+
+    def open_month_sheet(self, title: str, header: Sequence[str]) -> bool:
+        import gspread
+
+        try:
+            self._ws(title)
+            return False
+        except gspread.WorksheetNotFound:
+            ws = self.governor.call("write", self.sh.add_worksheet, title=title, rows=NEW_SHEET_ROWS, cols=NEW_SHEET_COLS)
+            self._sheets[title] = ws
+            self._rows[title] = NEW_SHEET_ROWS
+            self.write(title, [Block(1, [list(header)])])
+            return True
+
+    def read_range(self, title: str, a1: str) -> List[List[str]]:
+        ws = self._ws(title)
+        return [list(r) for r in self.governor.call("read", ws.get, a1)]
+
+    def write(self, title: str, blocks: Sequence[Block]) -> None:
+        ws = self._ws(title)
+        requests = []
+        need = max((b.start_row + len(b.rows) - 1 for b in blocks), default=0)
+        if need > self._rows[title]:
+            grow = need - self._rows[title] + GROW_ROWS
+            requests.append({"appendDimension": {"sheetId": ws.id, "dimension": "ROWS", "length": grow}})
+        for b in blocks:
+            requests.append({
+                "updateCells": {
+                    "start": {"sheetId": ws.id, "rowIndex": b.start_row - 1, "columnIndex": 0},
+                    "rows": [{"values": [_cell(v, b.bold) for v in r]} for r in b.rows],
+                    "fields": "userEnteredValue,userEnteredFormat.textFormat.bold",
+                }
+            })
+        self.governor.call("write", self.sh.batch_update, {"requests": requests})
+        if requests and "appendDimension" in requests[0]:
+            self._rows[title] += requests[0]["appendDimension"]["length"]
+
+    def delete_rows(self, title: str, start: int, end: int) -> None:
+        ws = self._ws(title)
+        self.governor.call("write", ws.delete_rows, start, end)
+        self._rows[title] -= end - start + 1
+
+class MemoryBackend:
+    def __init__(self):
+        self.sheets: Dict[str, Dict[Tuple[int, int], object]] = {}
+        self.bold: Dict[str, set] = {}
+
+    def open_month_sheet(self, title: str, header: Sequence[str]) -> bool:
+        if title in self.sheets:
+            return False
+        self.sheets[title] = {}
+        self.bold[title] = set()
+        self.write(title, [Block(1, [list(header)])])
+        return True
+
+    def last_row(self, title: str) -> int:
+        return max((r for r, _ in self.sheets[title]), default=0)
+
+    def read_range(self, title: str, a1: str) -> List[List[str]]:
+        cells = self.sheets[title]
+        r1, c1, r2, c2 = parse_a1(a1)
+        r1, c1 = r1 or 1, c1 or 1
+        r2 = r2 or self.last_row(title)
+        c2 = c2 or max((c for _, c in cells), default=0)
+        out = [["" if cells.get((r, c)) is None else str(cells[(r, c)]) for c in range(c1, c2 + 1)]
+               for r in range(r1, r2 + 1)]
+        # как и Sheets API, хвостовые пустые строки и ячейки не возвращаем
+        out = [list(_rstrip(r)) for r in out]
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    def write(self, title: str, blocks: Sequence[Block]) -> None:
+        cells, bold = self.sheets[title], self.bold[title]
+        for b in blocks:
+            for i, row in enumerate(b.rows):
+                for j, v in enumerate(row):
+                    cells[(b.start_row + i, j + 1)] = v
+                (bold.add if b.bold else bold.discard)(b.start_row + i)
+
+    def delete_rows(self, title: str, start: int, end: int) -> None:
+        n = end - start + 1
+        cells = self.sheets[title]
+        self.sheets[title] = {
+            (r - n if r > end else r, c): v for (r, c), v in cells.items() if not start <= r <= end
+        }
+        self.bold[title] = {r - n if r > end else r for r in self.bold[title] if not start <= r <= end}
+
+    def rows(self, title: str) -> List[List]:
+        cells = self.sheets[title]
+        width = max((c for _, c in cells), default=0)
+        return [[cells.get((r, c), "") for c in range(1, width + 1)] for r in range(1, self.last_row(title) + 1)]
+
+def _rstrip(row):
+    row = list(row)
+    while row and row[-1] == "":
+        row.pop()
+    return row
+
+class RecordingBackend:
+    def __init__(self, inner):
+        self.inner = inner
+        self.calls = Counter()
+
+    def open_month_sheet(self, title: str, header: Sequence[str]) -> bool:
+        self.calls["open_month_sheet"] += 1
+        return self.inner.open_month_sheet(title, header)
+
+    def read_range(self, title: str, a1: str) -> List[List[str]]:
+        self.calls["read_range"] += 1
+        return self.inner.read_range(title, a1)
+
+    def write(self, title: str, blocks: Sequence[Block]) -> None:
+        self.calls["write"] += 1
+        return self.inner.write(title, blocks)
+
+    def delete_rows(self, title: str, start: int, end: int) -> None:
+        self.calls["delete_rows"] += 1
+        return self.inner.delete_rows(title, start, end)
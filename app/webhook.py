@@ -0,0 +1,99 @@
+import os
+import hmac
+import asyncio
+import signal
+import logging
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+log = logging.getLogger(__name__)
+
+# Режим вебхука: PAYBOT_MODE=webhook. Без WEBHOOK_URL вебхук в Telegram не регистрируется —
+# удобно гонять локально, POST-ая записанные апдейты на http://HOST:PORT/PATH.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").strip()
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/tg/webhook").strip() or "/tg/webhook"
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "127.0.0.1").strip()
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "").strip()
+WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "8"))
+QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE", "256"))
+DRAIN_TIMEOUT = 30.0
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+def enabled() -> bool:
+    return os.environ.get("PAYBOT_MODE", "polling").strip().lower() == "webhook"
+
+def make_app(bot: Bot, queue: asyncio.Queue) -> web.Application:
+    async def handle(request: web.Request) -> web.Response:
+        got = request.headers.get(SECRET_HEADER, "")
+        if not WEBHOOK_SECRET or not hmac.compare_digest(got.encode(), WEBHOOK_SECRET.encode()):
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception:
+            return web.Response(status=400)
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram повторит доставку позже
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    return app
+
+async def _worker(bot: Bot, dp: Dispatcher, queue: asyncio.Queue):
+    while True:
+        update = await queue.get()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:
+            log.exception("update %s failed", update.update_id)
+        finally:
+            queue.task_done()
+
+async def run(bot: Bot, dp: Dispatcher):
+    # без секрета любой, кто достучится до порта, подделает апдейт от имени админа
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET is empty, refusing to start in webhook mode")
+    queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    workers = [asyncio.create_task(_worker(bot, dp, queue)) for _ in range(WORKERS)]
+
+    runner = web.AppRunner(make_app(bot, queue))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await dp.emit_startup(bot=bot)
+    try:
+        await site.start()
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+        log.info("webhook listening on %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+        await stop.wait()
+    finally:
+        # сначала перестаём принимать апдейты, потом дорабатываем очередь;
+        # вебхук не снимаем — Telegram накопит апдейты до следующего старта
+        await site.stop()
+        try:
+            await asyncio.wait_for(queue.join(), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.warning("webhook queue not drained in %.0fs, %d updates dropped", DRAIN_TIMEOUT, queue.qsize())
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
@@ -0,0 +1,60 @@
+import json
+import time
+import itertools
+from collections import Counter
+
+from aiohttp import web
+
+# Локальная замена Bot API: отвечает на методы, которые дёргает бот, и считает вызовы.
+MESSAGE_METHODS = {
+    "sendmessage", "sendphoto", "senddocument", "editmessagetext", "editmessagereplymarkup",
+}
+
+class FakeTelegram:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.calls = Counter()
+        self._ids = itertools.count(1)
+        self._runner = None
+
+    @property
+    def base(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def _message(self, form) -> dict:
+        chat_id = int(form.get("chat_id") or 0)
+        return {
+            "message_id": int(form.get("message_id") or next(self._ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": form.get("text") or form.get("caption") or "",
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+        form = await request.post()
+        if method in MESSAGE_METHODS:
+            result = self._message(form)
+        elif method == "sendmediagroup":
+            media = json.loads(form.get("media") or "[]")
+            result = [self._message(form) for _ in media]
+        elif method == "getme":
+            result = {"id": 42, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
@@ -0,0 +1,248 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import itertools
+from collections import defaultdict
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+
+from app import db, adb, migrations, export_one, middleware
+from app import main as paybot
+from app.exporter import ExportWorker
+from app.fsm_storage import SQLiteStorage
+from app.notify import FanOut
+from app.sheets_backend import MemoryBackend, RecordingBackend
+
+from .fake_telegram import FakeTelegram
+
+# Нагрузочный прогон: настоящий диспетчер из app/main.py против локального Bot API
+# и таблицы в памяти (MemoryBackend). python -m bench.run --users 200 --admins 3
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    k = min(len(s) - 1, max(0, round(p / 100 * (len(s) - 1))))
+    return s[k]
+
+class Harness:
+    def __init__(self, bot: Bot, dp: Dispatcher):
+        self.bot = bot
+        self.dp = dp
+        self.latency = defaultdict(list)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+
+    def _message(self, uid: int, text: str) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": self._user(uid),
+            "text": text,
+        }
+
+    async def _feed(self, step: str, payload: dict):
+        update = Update.model_validate({"update_id": next(self._update_ids), **payload}, context={"bot": self.bot})
+        t0 = time.perf_counter()
+        await self.dp.feed_update(self.bot, update)
+        self.latency[step].append(time.perf_counter() - t0)
+
+    async def text(self, step: str, uid: int, text: str):
+        await self._feed(step, {"message": self._message(uid, text)})
+
+    async def callback(self, step: str, uid: int, data: str):
+        await self._feed(step, {"callback_query": {
+            "id": str(next(self._update_ids)),
+            "from": self._user(uid),
+            "chat_instance": str(uid),
+            "message": self._message(uid, "card"),
+            "data": data,
+        }})
+
+    async def photo(self, step: str, uid: int, file_key: str, album: str):
+        m = self._message(uid, "")
+        del m["text"]
+        m["photo"] = [{"file_id": f"ph-{file_key}", "file_unique_id": f"u-{file_key}", "width": 1, "height": 1}]
+        m["media_group_id"] = album
+        await self._feed(step, {"message": m})
+
+    async def new_request(self, uid: int, n: int, album: int = 0):
+        await self.text("new", uid, "/new")
+        await self.text("title", uid, f"Заявка {uid}/{n}: ремонт кофемашины")
+        await self.text("amount", uid, f"{1000 + uid * 10 + n}.50")
+        await self.callback("paytype", uid, "paynew:bank")
+        await self.callback("budget", uid, "budnew:kitchen")
+        if album:
+            for i in range(album):
+                await self.photo("album_part", uid, f"{uid}-{n}-{i}", f"{uid}-{n}")
+            await self.text("attachment", uid, "готово")
+        else:
+            await self.text("attachment", uid, "нет")
+
+    async def user_requests(self, uid: int, per_user: int, album: int = 0):
+        for n in range(per_user):
+            await self.new_request(uid, n, album)
+
+    async def admin_flow(self, aid: int, req_ids, edit_every: int):
+        for i, req_id in enumerate(req_ids):
+            if edit_every and i % edit_every == 0:
+                await self.callback("edit", aid, f"edit:{req_id}")
+                await self.callback("edit_choose", aid, f"editfield:{req_id}:amount")
+                await self.text("edit_amount", aid, "777")
+            status = "approved" if i % 4 else "rejected"
+            await self.callback("decide", aid, f"decide:{req_id}:{status}")
+            await self.text("decision_comment", aid, "-")
+
+async def bench(users: int, per_user: int, admins: int, edit_every: int, real_limits: bool,
+                user_limits: bool = False, album: int = 0) -> bool:
+    tmp = tempfile.TemporaryDirectory(prefix="paybot-bench-")
+    db.DB = os.path.join(tmp.name, "db.sqlite3")
+    await adb.run(migrations.migrate)
+
+    admin_ids = [900000 + i for i in range(admins)]
+    os.environ["ADMINS"] = ",".join(str(a) for a in admin_ids)
+
+    db_ops = [0, 0.0]
+    orig_run = adb.run
+
+    async def counting_run(fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await orig_run(fn, *args, **kwargs)
+        finally:
+            db_ops[0] += 1
+            db_ops[1] += time.perf_counter() - t0
+
+    adb.run = counting_run
+
+    api = FakeTelegram()
+    await api.start()
+    bot = Bot(token="42:BENCH", session=AiohttpSession(api=TelegramAPIServer.from_base(api.base)))
+    storage = SQLiteStorage()
+    await storage.load()
+    dp = Dispatcher(storage=storage)
+    if user_limits:
+        throttle = middleware.setup(dp, bot)
+    else:
+        throttle = middleware.setup(dp, bot, rate=1e9, burst=1e9)
+    export_worker = ExportWorker(bot)
+    export_worker.use_backend(RecordingBackend(MemoryBackend()))
+    if real_limits:
+        fanout = FanOut(bot)
+    else:
+        fanout = FanOut(bot, global_rate=1e9, chat_rate=1e9, chat_burst=1e9)
+    paybot.register_handlers(dp, bot, fanout, export_worker)
+    export_worker.start()
+
+    h = Harness(bot, dp)
+    t0 = time.perf_counter()
+    # диалоги одного пользователя идут по очереди (у него один ключ FSM), разные пользователи — параллельно
+    await asyncio.gather(*(h.user_requests(1000 + u, per_user, album) for u in range(users)))
+    t_create = time.perf_counter() - t0
+
+    # каждый файл альбома должен дойти до request_attachments, в том числе под флуд-контролем
+    with db.conn() as c:
+        stored = c.execute("SELECT COUNT(*) FROM request_attachments").fetchone()[0]
+        req_ids = [r["id"] for r in c.execute("SELECT id FROM requests WHERE status = 'new' ORDER BY id")]
+    t0 = time.perf_counter()
+    await asyncio.gather(*(
+        h.admin_flow(aid, req_ids[i::admins], edit_every) for i, aid in enumerate(admin_ids)
+    ))
+    t_admin = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    await export_worker.queue.join()
+    t_catchup = time.perf_counter() - t0
+
+    with db.conn() as c:
+        decided = c.execute("SELECT COUNT(*) FROM requests WHERE status IN ('approved', 'rejected')").fetchone()[0]
+        in_sheets = c.execute("SELECT COUNT(*) FROM requests WHERE exported_to_sheets = 1").fetchone()[0]
+
+    # отдельный замер экспорта: всё заново в пустую таблицу одним проходом
+    with db.conn() as c:
+        c.execute("UPDATE requests SET exported_to_sheets = 0")
+        c.execute("DELETE FROM consumer_offsets")
+        c.execute("DELETE FROM sheet_rows")
+        c.execute("DELETE FROM sheet_totals")
+        c.commit()
+    sheets = RecordingBackend(MemoryBackend())
+    t0 = time.perf_counter()
+    exported = await asyncio.to_thread(export_one.export_pending, sheets)
+    t_export = time.perf_counter() - t0
+
+    n_db = db_ops[0]
+    t0 = time.perf_counter()
+    for req_id in req_ids[:500]:
+        await adb.get_request(req_id)
+    t_reads = time.perf_counter() - t0
+    n_reads = min(len(req_ids), 500)
+
+    await export_worker.stop()
+    await storage.close()
+    await bot.session.close()
+    await api.stop()
+    adb.run = orig_run
+    await adb.shutdown()
+    tmp.cleanup()
+
+    all_lat = [x for v in h.latency.values() for x in v]
+    print(f"requests: {len(req_ids)} from {users} users, {admins} admins")
+    print(f"create flow: {t_create:.2f}s, admin flow: {t_admin:.2f}s, export catch-up: {t_catchup:.2f}s")
+    print()
+    print(f"{'handler':<18}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step, v in list(h.latency.items()) + [("ALL", all_lat)]:
+        print(f"{step:<18}{len(v):>7}{percentile(v, 50) * 1e3:>10.2f}"
+              f"{percentile(v, 95) * 1e3:>10.2f}{percentile(v, 99) * 1e3:>10.2f}")
+    print()
+    print(f"db ops in flows: {n_db}, {n_db / (t_create + t_admin):.0f} ops/s, "
+          f"avg {db_ops[1] / max(n_db, 1) * 1e3:.2f} ms incl. queueing")
+    print(f"db point reads: {n_reads / t_reads:.0f} ops/s")
+    print(f"export: {len(exported)} rows in {t_export:.3f}s = {len(exported) / max(t_export, 1e-9):.0f} rows/s, "
+          f"sheets calls: {dict(sheets.calls)}")
+    print(f"telegram calls: {dict(api.calls)}")
+
+    # Выброшенные флуд-контролем апдейты не доходят до хендлеров, а их почти нулевая задержка
+    # попадает в перцентили, поэтому такой прогон не считается чистым.
+    checks = [
+        ("requests created", len(req_ids), users * per_user),
+        ("requests decided", decided, len(req_ids)),
+        ("decisions exported", in_sheets, decided),
+        ("throttled updates", throttle.dropped, 0),
+    ]
+    if album:
+        checks.append(("album attachments stored", stored, users * per_user * album))
+    print()
+    ok = True
+    for name, got, want in checks:
+        print(f"{name}: {got}, expected {want}" + ("" if got == want else "  FAILED"))
+        ok = ok and got == want
+    return ok
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="paybot load benchmark")
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--per-user", type=int, default=2)
+    ap.add_argument("--admins", type=int, default=3)
+    ap.add_argument("--edit-every", type=int, default=5, help="every Nth request goes through the edit flow first, 0 = never")
+    ap.add_argument("--real-limits", action="store_true", help="keep Telegram rate limits in the fan-out")
+    ap.add_argument("--user-limits", action="store_true",
+                    help="per-user flood control as in production; the run fails if any update gets throttled")
+    ap.add_argument("--album", type=int, default=0, help="attach an album of N photos to every request and check they are all stored")
+    args = ap.parse_args(argv)
+    ok = asyncio.run(bench(args.users, args.per_user, args.admins, args.edit_every, args.real_limits,
+                           args.user_limits, args.album))
+    if not ok:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])